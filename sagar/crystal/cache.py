@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import numpy
+
+# 缓存格式的版本，算法改变导致结果不同时增加，旧的缓存不再被使用
+_VERSION = 2
+
+
+class DiskCache(object):
+    """
+    以内容寻址的磁盘缓存，每一项为一个.npz文件，文件名为键。
+    用于重复使用相同母体结构的非重复hnf和超胞置换群，见`get_cache`。
+
+    parameters:
+
+    directory: str, 缓存目录，不存在时自动创建
+    max_size: int, 缓存文件的总字节数上限，超过时删除最久未使用的项，default=256MB
+    """
+
+    def __init__(self, directory, max_size=2**28):
+        self.directory = directory
+        self.max_size = max_size
+        # 缓存文件总字节数的估计，第一次写入时统计，之后随写入累加，超过上限时才清理
+        self._size = None
+
+    @staticmethod
+    def key(name, pcell, symprec, *args):
+        """
+        由名称、母体结构(lattice, positions, atoms)、symprec及其他参数给出键
+        """
+        h = hashlib.sha1()
+        h.update('{:}:{:s}'.format(_VERSION, name).encode())
+        for arr in (pcell.lattice, pcell.positions):
+            h.update(numpy.ascontiguousarray(arr, dtype='float64').tobytes())
+        h.update(numpy.ascontiguousarray(pcell.atoms, dtype='int64').tobytes())
+        h.update(repr(float(symprec)).encode())
+        for a in args:
+            if isinstance(a, numpy.ndarray):
+                h.update(numpy.ascontiguousarray(a, dtype='int64').tobytes())
+            else:
+                h.update(repr(a).encode())
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        return: dict of numpy.ndarray, 缓存中没有该项时为None
+        """
+        filename = self._filename(key)
+        try:
+            with numpy.load(filename) as data:
+                arrays = dict((k, data[k]) for k in data.files)
+        except (IOError, OSError, ValueError):
+            return None
+        # 记录使用时间，清理时保留最近使用的项
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return arrays
+
+    def save(self, key, **arrays):
+        """
+        写入一项，缓存目录不可写时什么都不做
+        """
+        filename = self._filename(key)
+        # 先写入临时文件再改名，其他进程不会读到写了一半的文件
+        tmp = '{:s}.{:d}.tmp'.format(filename, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp, 'wb') as f:
+                numpy.savez(f, **arrays)
+            if self._size is None:
+                self._size = self.size()
+            elif os.path.exists(filename):
+                self._size -= os.path.getsize(filename)
+            self._size += os.path.getsize(tmp)
+            os.rename(tmp, filename)
+            if self._size > self.max_size:
+                self.evict()
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def size(self):
+        """
+        缓存文件的总字节数
+        """
+        return sum(os.path.getsize(f) for f in self._files())
+
+    def evict(self):
+        """
+        删除最久未使用的项，直到总大小不超过max_size
+        """
+        files = sorted(self._files(), key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if total <= self.max_size:
+                break
+            total -= os.path.getsize(f)
+            os.remove(f)
+        self._size = total
+
+    def clear(self):
+        for f in self._files():
+            os.remove(f)
+        self._size = 0
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                if f.endswith('.npz')]
+
+
+def _default_directory():
+    directory = os.environ.get('SAGAR_CACHE_DIR')
+    if directory is not None:
+        return directory
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sagar')
+
+
+_directory = _default_directory()
+_cache = DiskCache(_directory) if _directory else None
+
+
+def get_cache():
+    """
+    `non_dup_hnfs`和`PermutationGroup`使用的缓存，为None时不使用缓存。
+    默认目录为$SAGAR_CACHE_DIR，未设定时为~/.cache/sagar，设为空字符串时不使用缓存。
+    """
+    return _cache
+
+
+def set_cache(directory, max_size=2**28):
+    """
+    设定缓存目录和大小上限，directory为None时不使用缓存
+    """
+    global _cache
+    _cache = DiskCache(directory, max_size) if directory else None
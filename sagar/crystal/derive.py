@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import time
 import numpy
+import itertools
+import multiprocessing
+from collections import OrderedDict
 
 from sagar.crystal.utils import non_dup_hnfs, snf
-from sagar.toolkit.mathtool import is_int_np_array, refine_positions
-from sagar.toolkit.derivetool import remove_redundant
+from sagar.crystal.cache import get_cache
+from sagar.toolkit.mathtool import is_int_np_array
+from sagar.toolkit.derivetool import remove_redundant, count_configurations
+from sagar.toolkit.derivetool import count_configurations_all_concentrations
+from sagar.toolkit.derivetool import remove_redundant_by_order, split_ranks, num_labelings
+from sagar.toolkit.derivetool import sample_configurations
 
 from sagar.crystal.structure import Cell
 
 
-def cells_nonredundant(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5):
+def cells_nonredundant(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5,
+                       min_distance=None, max_aspect=None, most_cubic=None):
     """
     cells_nonredundant return all non duplicated hnf extend cells.
 
@@ -20,12 +31,14 @@ def cells_nonredundant(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5)
     When finding duplicated hnfs the precesion, default=1e-5
     comprec: float, compare precision
     When finding the rotations symmetry of primitive cell, defalut=1e-5
+    min_distance, max_aspect, most_cubic: 超胞形状的限制，在扩胞之前删去，见`non_dup_hnfs`
 
     yield:
     A list of Cell objects.
     """
     # return [pcell.extend(hnf) for hnf in non_dup_hnfs(pcell, volume, dimension, symprec, comprec)]
-    for hnf in non_dup_hnfs(pcell, volume, dimension, symprec, comprec):
+    for hnf in non_dup_hnfs(pcell, volume, dimension, symprec, comprec,
+                            min_distance, max_aspect, most_cubic):
         cell = pcell.extend(hnf)
         if dimension == 2:
             cell = cell._get_niggli_2D(vacc=16, eps=comprec)
@@ -37,6 +50,9 @@ def cells_nonredundant(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5)
 class PermutationGroup(object):
     """
     所有的对称操作都是以置换矩阵的形式，作用在一个元素排列上。
+
+    超胞的对称群G由纯平移子群T和各陪集的代表元R（每种旋转一个）组成，
+    G = {r[t] | r in R, t in T}。T只与snf的对角元有关，在相同snf的超胞之间共用。
     """
 
     def __init__(self, pcell, mat):
@@ -44,38 +60,390 @@ class PermutationGroup(object):
             raise TypeError(
                 "want sagar.crystal.structure.Cell, got {:}".format(type(pcell)))
         self._pcell = pcell
-        self._mat = mat
+        self._mat = numpy.array(mat, dtype='int')
         self._snf, L, R = snf(mat)
+        self._opR = R
         self._volume = numpy.diagonal(self._snf).prod()
         self._nsites = len(pcell.atoms)  # 最小原胞中原子个数 如：hcp为2
+        self._sites = None
 
-    def get_symmetry_perms(self, symprec=1e-5):
-        # Q??: use whose rotations?????
-        supercell = self._pcell.extend(self._mat)
-        # import pdb; pdb.set_trace()
+    def get_symmetry_perms(self, symprec=1e-5, method='analytic'):
+        """
+        超胞所有对称操作的置换，(|G|, n) numpy.ndarray，已排序且没有重复
+
+        method: 'analytic' or 'spglib', see `get_rotation_perms`
+        """
+        rots = self.get_rotation_perms(symprec, method)
+        trans = self.get_pure_translation_perms()
+        result = rots[:, trans].reshape(-1, trans.shape[1])
+        result = numpy.unique(result, axis=0)
+        return result
+
+    def get_pure_translation_perms(self):
+        """
+        原胞的格矢在超胞中的平移所对应的置换，(|T|, n) numpy.ndarray，|T|为超胞体积。
+
+        Algorithm:
+        超胞中的格点v（原胞格矢的整数组合）在平移下构成群 Z^3 / Z^3 H，
+        由snf D = L H R 知其同构于 Z_d1 x Z_d2 x Z_d3，格点v对应 v R mod D。
+        按这样的编号，平移置换只与D有关，查表后换回超胞中的位点顺序即可。
+        """
+        diag = tuple(int(i) for i in numpy.diagonal(self._snf))
+        key = (diag, self._nsites)
+        if key not in _translations_of_snf:
+            _translations_of_snf[key] = _snf_translations(diag, self._nsites)
+        order = self._snf_order()
+        inv = numpy.argsort(order)
+        return inv[_translations_of_snf[key][:, order]]
+
+    def get_rotation_perms(self, symprec=1e-5, method='analytic'):
+        """
+        超胞对称群关于纯平移子群的各陪集的代表元，(|G|/|T|, n) numpy.ndarray
+
+        method:
+            'analytic': 由原胞的对称操作和snf直接用整数运算得到（默认），
+                不需要对超胞求对称性，也不需要比较超胞中的坐标
+            'spglib': 对超胞调用spglib，再逐个比较坐标得到置换
+        """
+        if method == 'analytic':
+            # 相同母体结构和hnf的结果从磁盘缓存中读取，见`sagar.crystal.cache`
+            cache = get_cache()
+            if cache is not None:
+                key = cache.key('rotation_perms', self._pcell, symprec, self._mat)
+                cached = cache.load(key)
+                if cached is not None:
+                    return cached['perms']
+            perms = self._analytic_rotation_perms(symprec)
+        elif method == 'spglib':
+            perms = self._spglib_rotation_perms(symprec)
+        else:
+            raise ValueError(
+                "method should be 'analytic' or 'spglib', got {:}".format(method))
+
+        # 不同的操作可能给出相同的置换，只保留置换陪集互不相同的代表元
+        translations = self.get_pure_translation_perms()
+        covered = set()
+        result = []
+        for perm in perms:
+            if perm.tobytes() in covered:
+                continue
+            covered.update(p.tobytes() for p in perm[translations])
+            result.append(perm)
+        result = numpy.array(result, dtype='intc')
+        if method == 'analytic' and cache is not None:
+            cache.save(key, perms=result)
+        return result
+
+    def _analytic_rotation_perms(self, symprec=1e-5):
+        """
+        Algorithm (G. L. W. Hart and R. W. Forcade, Phys. Rev. B 77, 224115 (2008)):
+        原胞的操作 x -> x W^T + tau 把原子a变为原子b加上格矢s_a。
+        若W保持超胞的格子不变（H W^T 的每行对应snf中的零元），则它是超胞的操作，
+        格点v上的原子a被移到格点 s_a + v W^T 上的原子b，
+        用snf编号 (s_a + v W^T) R mod D 即得到置换，全部为整数运算。
+        """
+        syms = self._pcell.get_symmetry(symprec)
+        atom_idx, points = self._site_points()
+        diag = numpy.diagonal(self._snf)
+        inv = numpy.argsort(self._snf_order())
+        pos = self._pcell.positions
+
+        perms = []
+        for rot, trans in zip(syms['rotations'], syms['translations']):
+            if numpy.any(numpy.mod(numpy.matmul(numpy.matmul(self._mat, rot.T), self._opR), diag)):
+                continue
+            # 原胞中原子的对应关系，只有原胞中的坐标比较
+            amap, shifts = _match_positions(numpy.matmul(pos, rot.T) + trans, pos, symprec)
+
+            new_points = shifts[atom_idx] + numpy.matmul(points, rot.T)
+            g = numpy.mod(numpy.matmul(new_points, self._opR), diag)
+            image = inv[amap[atom_idx] * self._volume + numpy.ravel_multi_index(g.T, diag)]
+            # 第j个元素为被移到位点j的位点
+            perms.append(numpy.argsort(image))
+        return perms
+
+    def _spglib_rotation_perms(self, symprec=1e-5):
         # 用超胞的旋转对称才是合理的
+        supercell = self._pcell.extend(self._mat)
         syms = supercell.get_symmetry(symprec)
         arr_rots, arr_trans = syms['rotations'], syms['translations']
 
-        result = numpy.zeros(
-            (len(arr_rots), self._nsites * self._volume), dtype='intc')
-
-        origin_positions = supercell.positions
-        origin_positions = refine_positions(origin_positions)
-        for i, (rot, trans) in enumerate(zip(arr_rots, arr_trans)):
-            new_positions = numpy.matmul(origin_positions, rot.T) + trans
-            moded = numpy.ones_like(new_positions, dtype='intc')
-            new_positions = numpy.mod(new_positions, moded)
-            new_positions = refine_positions(new_positions, atol=symprec)
-            # 寻找置换矩阵
-            for j, row in enumerate(origin_positions):
-                row = refine_positions(row, atol=symprec)
-                idx = numpy.where(
-                    (numpy.isclose(row, new_positions, atol=symprec)).all(axis=1))[0]
-                result[i, j] = idx
+        # 同一陪集的操作旋转相同，平移相差原胞的格矢
+        scale = int(round(1 / symprec))
+        reps = {}
+        for rot, trans in zip(arr_rots, arr_trans):
+            frac = numpy.around(numpy.matmul(trans, self._mat) / symprec).astype('int')
+            key = (rot.tobytes(), tuple(numpy.mod(frac, scale)))
+            if key not in reps:
+                reps[key] = (rot, trans)
+
+        inv = numpy.argsort(self._snf_order())
+        perms = []
+        for rot, trans in reps.values():
+            new_positions = numpy.matmul(supercell.positions, rot.T) + trans
+            image = inv[self._locate(new_positions, symprec)]
+            # 第j个元素为被移到位点j的位点
+            perms.append(numpy.argsort(image))
+        return perms
+
+    def _locate(self, positions, symprec=1e-5):
+        """
+        超胞中分数坐标为positions (m, 3)的位点在snf编号中的序号
+
+        将坐标换为原胞的分数坐标，减去对应的原胞原子坐标后得到整数的格点v，
+        v R mod D 即为格点序号，用整数直接查表，不需要在所有位点中搜索。
+        """
+        amap, points = _match_positions(numpy.matmul(positions, self._mat),
+                                        self._pcell.positions, symprec)
+        diag = numpy.diagonal(self._snf)
+        g = numpy.mod(numpy.matmul(points, self._opR), diag)
+        return amap * self._volume + numpy.ravel_multi_index(g.T, diag)
+
+    def _site_points(self):
+        """
+        超胞中每个位点对应的原胞原子序号和格点（原胞格矢的整数组合）
+        """
+        if self._sites is None:
+            n = self._nsites * self._volume
+            # extend给出的位点按原胞中的原子依次排列
+            atom_idx = numpy.arange(n) // self._volume
+            frac = numpy.matmul(self._pcell.extend(self._mat).positions, self._mat)
+            points = numpy.around(frac - self._pcell.positions[atom_idx]).astype('int')
+            self._sites = (atom_idx, points)
+        return self._sites
+
+    def _snf_order(self):
+        """
+        超胞中每个位点在snf编号（原胞中的原子序号 * 体积 + 格点序号）中的位置
+        """
+        atom_idx, points = self._site_points()
+        diag = numpy.diagonal(self._snf)
+        g = numpy.mod(numpy.matmul(points, self._opR), diag)
+        return atom_idx * self._volume + numpy.ravel_multi_index(g.T, diag)
+
+
+# 以(snf对角元, 原胞原子数)为键，按snf编号的纯平移置换
+_translations_of_snf = {}
+
+
+def _snf_translations(diag, nsites):
+    """
+    Z_d1 x Z_d2 x Z_d3 中所有平移对应的置换，位点按snf编号
+    """
+    volume = diag[0] * diag[1] * diag[2]
+    points = numpy.indices(diag).reshape(3, -1).T
+    moved = numpy.mod(points[:, numpy.newaxis] + points[numpy.newaxis], diag)
+    idx = numpy.ravel_multi_index(numpy.moveaxis(moved, -1, 0), diag)
+    offsets = numpy.arange(nsites) * volume
+    return (offsets[:, numpy.newaxis, numpy.newaxis] + idx).transpose(1, 0, 2).reshape(volume, -1)
+
+
+def _match_positions(positions, origin, symprec=1e-5):
+    """
+    找出每个坐标与origin中哪个坐标相差一个格矢（均为分数坐标）
+
+    return:
+    idx: (m,) numpy.ndarray, positions[i]与origin[idx[i]]对应
+    shifts: (m, 3) int numpy.ndarray, positions[i] = origin[idx[i]] + shifts[i]
+    """
+    delta = positions[:, numpy.newaxis] - origin[numpy.newaxis]
+    is_same = numpy.all(numpy.abs(delta - numpy.around(delta)) < symprec, axis=-1)
+    found = is_same.any(axis=1)
+    if not found.all():
+        raise ValueError("position {:} not found in {:}".format(
+            positions[numpy.argmin(found)], origin))
+    idx = numpy.argmax(is_same, axis=1)
+    shifts = numpy.around(delta[numpy.arange(len(positions)), idx]).astype('int')
+    return idx, shifts
+
+
+def _confs_of_hnf(pcell, hnf, sites, volume, e_num, symprec, method, primitive_only,
+                  start=0, progress=False):
+    """
+    产生一个hnf超胞中所有不等价的构型及简并度。
+    各个hnf之间互不依赖，因此可以放在不同的进程中计算。
+
+    progress为True时，在输出中插入`_Progress`标记：
+    'ccsort'方法每处理完一段排列序号标记一次（可以从start处继续），
+    处理完整个hnf时再标记一次。
+    """
+    hfpg = PermutationGroup(pcell, hnf)
+    supercell = pcell.extend(hnf)
+    _sites = numpy.repeat(sites, volume, axis=0)
+
+    if method == 'ccsort':
+        # 相同snf的超胞平移操作相同，由PermutationGroup缓存
+        rots = hfpg.get_rotation_perms(symprec)
+        trans = hfpg.get_pure_translation_perms()
+        # 有序枚举不依赖已出现的构型，可以按序号分段处理
+        total = num_labelings(_sites, e_num)
+        lo = start
+        while lo < total:
+            hi = min(lo + _Progress.ranks, total)
+            for mol, d in remove_redundant_by_order(supercell.positions, _sites, rots, e_num,
+                                                    lo, hi, trans):
+                c = Cell(supercell.lattice, mol[0], mol[1])
+                if primitive_only and not c.is_primitive(symprec):
+                    continue
+                yield (c, d)
+            if progress:
+                yield _Progress(hi)
+            lo = hi
+    else:
+        perms = hfpg.get_symmetry_perms(symprec)
+        for mol, d in remove_redundant(supercell.positions, _sites, perms, e_num, method=method):
+            c = Cell(supercell.lattice, mol[0], mol[1])
+            if primitive_only and not c.is_primitive(symprec):
+                continue
+            yield (c, d)
+
+    if progress:
+        yield _Progress()
+
+
+def _confs_of_ranks(supercell, sites, rots, trans, e_num, start, stop, progress=False):
+    """
+    产生一个超胞中序号在[start, stop)之间的排列里的规范构型及简并度，
+    rots, trans见`PermutationGroup`
+    """
+    for mol, d in remove_redundant_by_order(supercell.positions, sites, rots, e_num,
+                                            start, stop, trans):
+        c = Cell(supercell.lattice, mol[0], mol[1])
+        yield (c, d)
+    if progress:
+        yield _Progress(stop)
+
+
+class _Progress(object):
+    """
+    插入在构型输出中的进度标记。
+    rank: 当前hnf中序号小于rank的排列已经处理完毕，为None时表示整个hnf处理完毕。
+    """
+    # 'ccsort'方法每处理这么多个排列标记一次进度
+    ranks = 2 ** 16
+
+    def __init__(self, rank=None):
+        self.rank = rank
+
+
+class _Checkpoint(object):
+    """
+    枚举的检查点，以json格式保存在文件中:
+    hnf: 序号小于hnf的超胞已经处理完毕
+    rank: 第hnf个超胞中序号小于rank的排列已经处理完毕
+    skip: 在上述进度之后又已经输出的构型数目，继续时跳过
+    count: 已经输出的构型数目
+    job: 产生构型的函数及参数，继续时必须一致
+    """
+    # 两次写入文件之间至少间隔的秒数，处理完一个hnf时总是写入
+    interval = 60
+
+    def __init__(self, filename, job):
+        self.filename = filename
+        self.job = job
+        self.hnf, self.rank, self.skip, self.count = 0, 0, 0, 0
+        self._saved_at = time.time()
+        if filename is not None and os.path.exists(filename):
+            state = read_checkpoint(filename)
+            if state['job'] != job:
+                raise ValueError("checkpoint {:} is for {:}, not for {:}".format(
+                    filename, state['job'], job))
+            self.hnf, self.rank = state['hnf'], state['rank']
+            self.skip, self.count = state['skip'], state['count']
+
+    def track(self, items):
+        """
+        去掉`_Progress`标记并据此记录进度，输出其余的构型。
+        生成器被中途关闭时也写入检查点。
+        """
+        # 继续时，上次在最后一个标记之后已经输出的构型
+        done = self.skip
+        try:
+            for item in items:
+                if isinstance(item, _Progress):
+                    done = self.skip = 0
+                    if item.rank is None:
+                        self.hnf, self.rank = self.hnf + 1, 0
+                        self.save()
+                    else:
+                        self.rank = item.rank
+                        if time.time() - self._saved_at >= self.interval:
+                            self.save()
+                    continue
+                if done > 0:
+                    done -= 1
+                    continue
+                yield item
+                # 构型已被使用后才计数
+                self.count += 1
+                self.skip += 1
+        finally:
+            self.save()
+
+    def save(self):
+        if self.filename is None:
+            return
+        state = {'job': self.job, 'hnf': self.hnf, 'rank': self.rank,
+                 'skip': self.skip, 'count': self.count}
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.filename)
+        self._saved_at = time.time()
+
+
+def read_checkpoint(filename):
+    """
+    读取`ConfigurationGenerator`写下的检查点
+
+    return:
+    dict, 'hnf', 'rank', 'skip', 'count' and 'job', see `_Checkpoint`
+    """
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _job(name, *args):
+    """
+    检查点中记录的任务描述
+    """
+    return '{:s}{:}'.format(name, tuple(_plain(a) for a in args))
+
+
+def _plain(obj):
+    if isinstance(obj, (list, tuple, numpy.ndarray)):
+        return tuple(_plain(i) for i in obj)
+    if isinstance(obj, numpy.integer):
+        return int(obj)
+    return obj
+
+
+def _run_task(task):
+    func, args = task[0], task[1:]
+    return list(func(*args))
+
+
+def _map_tasks(func, tasks, workers=None):
+    """
+    依次输出每个任务的结果，每个任务为func（一个生成器函数）的参数。
+    workers大于1时，用进程池并行计算各个任务，结果按任务的顺序输出。
+    """
+    if workers is None or workers <= 1:
+        for args in tasks:
+            for i in func(*args):
+                yield i
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for results in pool.imap(_run_task, ((func,) + tuple(args) for args in tasks)):
+            for i in results:
+                yield i
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
-        result = numpy.unique(result, axis=0)
-        return result
 
 # 在较大体积的构型中，可能有结构已经在小的体积中出现过。
 # 那么是否要移除这些已经出现过的结构呢？
@@ -101,12 +469,16 @@ class ConfigurationGenerator(object):
         else:
             self._pcell = cell
 
-    def cons_max_volume(self, sites, max_volume, min_volume=1, dimension=3, symprec=1e-5):
+    def cons_max_volume(self, sites, max_volume, min_volume=1, dimension=3, symprec=1e-5, method='jshash', workers=None, checkpoint=None):
         """
         parameters:
 
         pcell: Cell object, The primitive cell to be extended
         sites: disorderd sites infomation.
+        method: str, 'jshash' or 'ccsort', see `remove_redundant`
+        workers: int, number of processes to deal with supercells in parallel,
+            default=None for serial. The order of output is not changed.
+        checkpoint: str, filename of checkpoint, see `cons_specific_volume`
 
         yield:
 
@@ -114,36 +486,42 @@ class ConfigurationGenerator(object):
 
         """
         # 该函数产生所有构型用于确定基态相图
-        for volume in range(min_volume, max_volume + 1):
-            hnfs = non_dup_hnfs(self._pcell, volume, dimension, symprec)
-            dict_trans = {}  # 记录已经产生过的snf，相同snf的平移操作相同。
-            for h in hnfs:
-                hfpg = PermutationGroup(self._pcell, h)
-                # 此处的平移操作不必每次重新计算，因为相同snf平移操作相同
-                # 可以用字典来标记查询。若没有这样的操作，那么就没有snf带来的效率提升。
-                # quotient = hfpg.get_quotient()
-                # if not quotient in dict_trans:
-                #     dict_trans[quotient] = hfpg.get_pure_translations(symprec)
-                # trans = dict_trans[quotient]
-                # rots = hfpg.get_pure_rotations(symprec)
-                perms = hfpg.get_symmetry_perms(symprec)
-
-                supercell = self._pcell.extend(h)
-                _sites = numpy.repeat(sites, volume, axis=0)
-
-                for mol, _ in remove_redundant(supercell.positions, _sites, perms):
-                    c = Cell(supercell.lattice, mol[0], mol[1])
-                    if c.is_primitive(symprec):
-                        yield c
+        job = _job('cons_max_volume', hash(self._cell), sites, max_volume, min_volume,
+                   dimension, symprec, method)
+        ckpt = _Checkpoint(checkpoint, job)
+
+        def tasks():
+            idx = 0
+            for volume in range(min_volume, max_volume + 1):
+                for h in non_dup_hnfs(self._pcell, volume, dimension, symprec):
+                    if idx >= ckpt.hnf:
+                        start = ckpt.rank if idx == ckpt.hnf else 0
+                        yield (self._pcell, h, sites, volume, None, symprec, method, True,
+                               start, checkpoint is not None)
+                    idx += 1
+
+        for c, _ in ckpt.track(_map_tasks(_confs_of_hnf, tasks(), workers)):
+            yield c
 
     # 特定体积胞
-    def cons_specific_volume(self, sites, volume=2, e_num=None, dimension=3, symprec=1e-5):
+    def cons_specific_volume(self, sites, volume=2, e_num=None, dimension=3, symprec=1e-5, method='jshash', workers=None, checkpoint=None):
         """
         parameters:
 
         sites: 2D list, disorderd sites infomation.
         volume: int, certain volume with subperiodic.
         symprec: float, precision for symmetry find.
+        method: str, 'jshash' or 'ccsort', see `remove_redundant`
+        workers: int, number of processes to deal with supercells in parallel,
+            default=None for serial. The order of output is not changed.
+        checkpoint: str, filename of checkpoint, default=None for no checkpoint.
+            The progress is written to it from time to time, when a supercell
+            is finished and when the generator is closed. If it exists, the
+            generation is resumed from it without the configurations already
+            yielded. With 'jshash' method an unfinished supercell is restarted,
+            with 'ccsort' method it is resumed from the serial int of arrangement
+            reached. If the process is killed, the configurations after the last
+            write are yielded again. See `read_checkpoint`.
 
         yield:
 
@@ -153,28 +531,17 @@ class ConfigurationGenerator(object):
         """
         # TODO: if it is a supercell as input: get Error
         # 该函数产生特定体积下所有构型（包括超胞）和简并度，用于统计平均
+        job = _job('cons_specific_volume', hash(self._cell), sites, volume, e_num,
+                   dimension, symprec, method)
+        ckpt = _Checkpoint(checkpoint, job)
         hnfs = non_dup_hnfs(self._pcell, volume, dimension, symprec)
-        dict_trans = {}
-        for h in hnfs:
-            hfpg = PermutationGroup(self._pcell, h)
-            # 此处的平移操作不必每次重新计算，因为相同snf平移操作相同
-            # 可以用字典来标记查询。若没有这样的操作，那么就没有snf带来的效率提升。
-            # For hnf with same snf, translations are same.
-            # quotient = hfpg.get_quotient()
-            # if not quotient in dict_trans:
-            #     dict_trans[quotient] = hfpg.get_pure_translations(symprec)
-            # trans = dict_trans[quotient]
-            # rots = hfpg.get_pure_rotations(symprec)
-            perms = hfpg.get_symmetry_perms(symprec)
-
-            supercell = self._pcell.extend(h)
-            _sites = numpy.repeat(sites, volume, axis=0)
-
-            for mol, d in remove_redundant(supercell.positions, _sites, perms, e_num):
-                c = Cell(supercell.lattice, mol[0], mol[1])
-                yield (c, d)
+        tasks = ((self._pcell, h, sites, volume, e_num, symprec, method, False,
+                  ckpt.rank if idx == ckpt.hnf else 0, checkpoint is not None)
+                 for idx, h in enumerate(hnfs) if idx >= ckpt.hnf)
+        for c, d in ckpt.track(_map_tasks(_confs_of_hnf, tasks, workers)):
+            yield (c, d)
 
-    def cons_specific_cell(self, sites, e_num=None, symprec=1e-5):
+    def cons_specific_cell(self, sites, e_num=None, symprec=1e-5, method='jshash', workers=None, checkpoint=None):
         """
         cons_specific_cell_and_c generate configurations of specific cell
         and specific concentration.
@@ -182,10 +549,150 @@ class ConfigurationGenerator(object):
         parameters:
         sites: list of (lists or tuples), represent element disorder of each sites
         e_num: tuple, number of atoms in disorderd sites.
+        method: str, 'jshash' or 'ccsort', see `remove_redundant`
+        workers: int, number of processes, default=None for serial.
+            When e_num is given and workers > 1, the arrangements are split into
+            ranges of serial int and each range is dealt in its own process with
+            'ccsort' method, whatever `method` is. The order of output is not changed.
+        checkpoint: str, filename of checkpoint, see `cons_specific_volume`
 
         e_num 特指无序位点的浓度，也就是原子比，而不是整体构型的元素原子比。有可能其他位点存在相同构型。
         !!限制，无序位点的组成必须是相同的，而上面几个函数的无序位点是可以不同的。!!
         """
+        mat = self._get_cell_mat()
+        # 按序号区间分给多个进程时总是用'ccsort'，检查点中记录实际使用的方法
+        by_ranks = e_num is not None and workers is not None and workers > 1
+        job = _job('cons_specific_cell', hash(self._cell), sites, e_num, symprec,
+                   'ccsort' if by_ranks else method)
+        ckpt = _Checkpoint(checkpoint, job)
+        if ckpt.hnf > 0:
+            return
+
+        if by_ranks:
+            pg = PermutationGroup(self._pcell, mat)
+            rots, trans = pg.get_rotation_perms(symprec), pg.get_pure_translation_perms()
+            supercell = self._pcell.extend(mat)
+            # 每个进程处理若干个序号区间，区间数多于进程数以平衡负载
+            tasks = ((supercell, sites, rots, trans, e_num, start, stop, checkpoint is not None)
+                     for start, stop in split_ranks(e_num, workers * 4, ckpt.rank))
+            confs = _map_tasks(_confs_of_ranks, tasks, workers)
+            if checkpoint is not None:
+                confs = itertools.chain(confs, [_Progress()])
+        else:
+            confs = _confs_of_hnf(self._pcell, mat, sites, 1, e_num, symprec, method, False,
+                                  ckpt.rank, checkpoint is not None)
+
+        for c, d in ckpt.track(confs):
+            yield (c, d)
+
+    def sample_specific_cell(self, sites, n_samples, e_num=None, symprec=1e-5, uniform=False, seed=None):
+        """
+        sample_specific_cell randomly draw non-redundant configurations of
+        specific cell without enumerating all of them, for cells too large
+        for `cons_specific_cell`.
+
+        parameters:
+        sites: list of (lists or tuples), represent element disorder of each sites
+        n_samples: int, number of configurations wanted, all configurations
+            are yielded if there are fewer.
+        e_num: tuple, number of atoms in disorderd sites.
+        uniform: bool, default=False, configurations are drawn with probability
+            proportional to their degeneracy. If True, every non-redundant
+            configuration has the same probability.
+        seed: int, random seed, default=None
+
+        yield:
+        a tuple (Cell, degeneracy) as `cons_specific_cell`, no configuration
+        is yielded twice. See `sagar.toolkit.derivetool.sample_configurations`
+        """
+        mat = self._get_cell_mat()
+        perms = PermutationGroup(self._pcell, mat).get_symmetry_perms(symprec)
+        supercell = self._pcell.extend(mat)
+        for mol, d in sample_configurations(supercell.positions, sites, perms, n_samples,
+                                            e_num, uniform, seed):
+            c = Cell(supercell.lattice, mol[0], mol[1])
+            yield (c, d)
+
+    def count_specific_volume(self, sites, volume=2, e_num=None, dimension=3, symprec=1e-5):
+        """
+        count_specific_volume give number of configurations of each
+        supercell without generating them, see `cons_specific_volume`.
+
+        parameters:
+
+        sites: 2D list, disorderd sites infomation.
+        volume: int, certain volume with subperiodic.
+        e_num: tuple, number of atoms in disorderd sites.
+        symprec: float, precision for symmetry find.
+
+        return:
+
+        a list of tuple
+        tuple[0]: 2D numpy.ndarray, hnf of the supercell
+        tuple[1]: int, number of non-redundant configurations of the supercell
+        """
+        _sites = numpy.repeat(sites, volume, axis=0)
+        counts = []
+        for h in non_dup_hnfs(self._pcell, volume, dimension, symprec):
+            perms = PermutationGroup(self._pcell, h).get_symmetry_perms(symprec)
+            counts.append((h, count_configurations(_sites, perms, e_num)))
+        return counts
+
+    def count_specific_cell(self, sites, e_num=None, symprec=1e-5):
+        """
+        count_specific_cell give number of configurations of specific cell
+        and specific concentration without generating them,
+        see `cons_specific_cell`.
+
+        return: int
+        """
+        mat = self._get_cell_mat()
+        perms = PermutationGroup(self._pcell, mat).get_symmetry_perms(symprec)
+        return count_configurations(sites, perms, e_num)
+
+    def count_table_specific_volume(self, sites, volume=2, dimension=3, symprec=1e-5):
+        """
+        count_table_specific_volume give number of configurations of all
+        concentrations of certain volume supercells in one pass.
+
+        parameters:
+
+        sites: 2D list, disorderd sites infomation.
+        volume: int, certain volume with subperiodic.
+        symprec: float, precision for symmetry find.
+
+        return:
+
+        OrderedDict, e_num (tuple) as key and number of non-redundant
+        configurations summed over all supercells as value, sorted by e_num.
+        """
+        _sites = numpy.repeat(sites, volume, axis=0)
+        table = {}
+        for h in non_dup_hnfs(self._pcell, volume, dimension, symprec):
+            perms = PermutationGroup(self._pcell, h).get_symmetry_perms(symprec)
+            for e_num, n in count_configurations_all_concentrations(_sites, perms).items():
+                table[e_num] = table.get(e_num, 0) + n
+        return OrderedDict(sorted(table.items()))
+
+    def count_table_specific_cell(self, sites, symprec=1e-5):
+        """
+        count_table_specific_cell give number of configurations of all
+        concentrations of specific cell in one pass.
+
+        return:
+
+        OrderedDict, e_num (tuple) as key and number of non-redundant
+        configurations as value, sorted by e_num.
+        """
+        mat = self._get_cell_mat()
+        perms = PermutationGroup(self._pcell, mat).get_symmetry_perms(symprec)
+        table = count_configurations_all_concentrations(sites, perms)
+        return OrderedDict(sorted(table.items()))
+
+    def _get_cell_mat(self):
+        """
+        cell 相对于其原胞的扩胞矩阵
+        """
         lat_cell = self._cell.lattice
         lat_pcell = self._pcell.lattice
         mat = numpy.matmul(lat_cell, numpy.linalg.inv(lat_pcell))
@@ -196,11 +703,4 @@ class ConfigurationGenerator(object):
             print("primitive cell:\n", lat_pcell)
             raise ValueError(
                 "cell lattice and its primitive cell lattice not convertable")
-        hfpg = PermutationGroup(self._pcell, mat)
-
-        perms = hfpg.get_symmetry_perms(symprec)
-
-        supercell = self._pcell.extend(mat)
-        for mol, d in remove_redundant(supercell.positions, sites, perms, e_num=e_num):
-            c = Cell(supercell.lattice, mol[0], mol[1])
-            yield (c, d)
+        return mat
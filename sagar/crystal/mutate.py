@@ -3,11 +3,9 @@
 # 该模块包含针对`sagar.crystal.structure`中
 # 的MutableCell产生的对象的操作。
 import numpy
-from itertools import product
 
 from sagar.crystal.structure import MutableCell
-from sagar.crystal.structure import get_symbol, car_to_frac, frac_to_car
-from sagar.toolkit.mathtool import distance
+from sagar.crystal.structure import get_symbol, car_to_frac, neighbor_list
 
 
 def cell_to_mcell(cell):
@@ -46,8 +44,9 @@ def remove_sites_in_a_circle(mcell, cc, radius, list_ele=None):
     ele: 要删除的元素的list，若为None，则删除所有元素找到的位点
         这里使用元素符号的列表
     """
+    is_close = _sites_in_radius(mcell._lattice, cc, mcell._sites, radius)
     for idx, s in enumerate(mcell._sites):
-        if _is_close_in_radius(mcell._lattice, cc, s[0], radius) and _is_in_ele(s[1], list_ele):
+        if is_close[idx] and _is_in_ele(s[1], list_ele):
             mcell.remove_site(idx)
 
 def rotate_sites_in_a_circle_by_z(mcell, cc, radius, degrees, radians=None, list_ele=None):
@@ -57,27 +56,24 @@ def rotate_sites_in_a_circle_by_z(mcell, cc, radius, degrees, radians=None, list
     ele: 要旋转的元素的list，若为None，则旋转所有元素找到的位点
         这里使用元素符号的列表
     """
+    is_close = _sites_in_radius(mcell._lattice, cc, mcell._sites, radius)
     for idx, s in enumerate(mcell._sites):
-        if _is_close_in_radius(mcell._lattice, cc, s[0], radius) and _is_in_ele(s[1], list_ele):
+        if is_close[idx] and _is_in_ele(s[1], list_ele):
             mcell.rotate_site_by_z(idx, cc, degrees)
 
-def _is_close_in_radius(lattice, p1, p2, radius):
-    # 截断圆对应的半径大于距离，说明两点在圆内，需要删除：返回True
-    # 因为周期性边界条件，首先将原始胞沿着x,y,z三个方向得到27个位置坐标
-
-    # TODO: 扩胞为3x3x3是不必要的，可以根据radius和lattice选择性扩胞，
-    # 若lattice的边或顶点在半径以内才需要选择向该方向扩胞
+def _sites_in_radius(lattice, cc, sites, radius):
+    # 截断圆对应的半径大于距离，说明位点在圆内：对应的元素为True
+    # 用近邻表求所有位点的周期性像到圆心的距离，只考虑半径内需要的像
     symprec = 1e-5
 
-    trans = numpy.array([i for i in product([-1, 0, 1], repeat=3)])
-    all_p1 = numpy.array(p1) + trans
-    car_p2 = frac_to_car(lattice, p2)
-    for each_p1 in all_p1:
-        car_p1 = frac_to_car(lattice, each_p1)
-        if radius - distance(car_p1, car_p2) > symprec:
-            return True
-            break
-    return False
+    is_close = numpy.zeros(len(sites), dtype='bool')
+    # 半径不大于精度时圆内没有位点
+    if len(sites) == 0 or radius <= symprec:
+        return is_close
+    positions = [s[0] for s in sites]
+    _, idx, _, distances = neighbor_list(lattice, positions, radius, centers=[cc])
+    is_close[idx[radius - distances > symprec]] = True
+    return is_close
 
 def _is_in_ele(ele, l_ele):
     if l_ele is None:
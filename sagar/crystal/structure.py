@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import numpy
 import spglib
 from pniggli import niggli_reduce
 
 from itertools import product
 
-from sagar.toolkit.mathtool import closest_pair
+from sagar.toolkit.mathtool import is_int_np_array, smith_normal_form
 from sagar.element.base import periodic_table_dict, get_symbol, symbol2number
 
 def car_to_frac(lattice, car_vec):
@@ -17,6 +18,81 @@ def frac_to_car(lattice, frac_vec):
     return numpy.matmul(frac_vec, lattice)
 
 
+def neighbor_list(lattice, positions, cutoff, centers=None):
+    """
+    周期性边界条件下距离不大于cutoff的所有(中心, 位点, 像)。
+
+    Algorithm:
+    沿每个格矢把晶胞分为若干格子，每个格子垂直于格矢方向的宽度不小于cutoff
+    （cutoff大于晶面间距时只有一个格子），位点按格子排序。
+    每个中心只与相邻的格子（及其需要的周期性像）中的位点求距离，不需要扩胞。
+
+    parameters:
+
+    lattice: 3x3 numpy.ndarray
+    positions: (n, 3) 分数坐标，可以不在0~1之间
+    cutoff: float, 截断距离，单位与lattice相同
+    centers: (m, 3) 分数坐标，default=None，即positions本身，此时不包括位点与自身
+
+    return:
+
+    idx_c: (M,) int numpy.ndarray, 中心的序号
+    idx_p: (M,) int numpy.ndarray, 位点的序号
+    images: (M, 3) int numpy.ndarray, 位点的像，距离矢量为 (positions[idx_p] + images - centers[idx_c]) * lattice
+    distances: (M,) numpy.ndarray
+    """
+    if cutoff <= 0:
+        raise ValueError("cutoff should be positive, got {:}".format(cutoff))
+    lattice = numpy.asarray(lattice, dtype='float64').reshape((3, 3))
+    positions = numpy.asarray(positions, dtype='float64').reshape((-1, 3))
+    is_self = centers is None
+    centers = positions if is_self else numpy.asarray(centers, dtype='float64').reshape((-1, 3))
+
+    # 移到0~1之间，最后把平移加回到像上
+    wrap_p, wrap_c = numpy.floor(positions), numpy.floor(centers)
+    frac_p, frac_c = positions - wrap_p, centers - wrap_c
+
+    # 晶面间距为倒格矢长度的倒数
+    widths = cutoff * numpy.linalg.norm(numpy.linalg.inv(lattice), axis=0)
+    n_max = max(1, int(numpy.ceil(len(positions) ** (1. / 3))))
+    n_bins = numpy.clip(numpy.floor(1 / widths), 1, n_max).astype('int')
+    reach = numpy.ceil(widths * n_bins).astype('int')
+
+    bin_p = numpy.minimum((frac_p * n_bins).astype('int'), n_bins - 1)
+    bin_c = numpy.minimum((frac_c * n_bins).astype('int'), n_bins - 1)
+    flat_p = numpy.ravel_multi_index(bin_p.T, n_bins)
+    order = numpy.argsort(flat_p, kind='mergesort')
+    starts = numpy.searchsorted(flat_p[order], numpy.arange(numpy.prod(n_bins) + 1))
+
+    idx_c, idx_p, images = [], [], []
+    for delta in product(*[range(-r, r + 1) for r in reach]):
+        shifted = bin_c + delta
+        target = numpy.ravel_multi_index((shifted % n_bins).T, n_bins)
+        counts = starts[target + 1] - starts[target]
+        total = counts.sum()
+        if total == 0:
+            continue
+        # 每个中心与目标格子中的所有位点
+        i = numpy.repeat(numpy.arange(len(centers)), counts)
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        idx_c.append(i)
+        idx_p.append(order[numpy.repeat(starts[target], counts) + offsets])
+        images.append(numpy.repeat(numpy.floor_divide(shifted, n_bins), counts, axis=0))
+    if not idx_c:
+        return (numpy.zeros(0, dtype='int'), numpy.zeros(0, dtype='int'),
+                numpy.zeros((0, 3), dtype='int'), numpy.zeros(0))
+    idx_c, idx_p, images = numpy.concatenate(idx_c), numpy.concatenate(idx_p), numpy.concatenate(images)
+
+    vecs = numpy.matmul(frac_p[idx_p] + images - frac_c[idx_c], lattice)
+    distances = numpy.sqrt(numpy.einsum('ij,ij->i', vecs, vecs))
+    keep = distances <= cutoff
+    if is_self:
+        keep &= (idx_c != idx_p) | numpy.any(images != 0, axis=1)
+    idx_c, idx_p, images, distances = idx_c[keep], idx_p[keep], images[keep], distances[keep]
+    images = (images + wrap_c[idx_c] - wrap_p[idx_p]).astype('int')
+    return idx_c, idx_p, images, distances
+
+
 class Cell(object):
     """
     Cell object represent a crystal structure.
@@ -29,16 +105,23 @@ class Cell(object):
     represent atom in periodic table. (用全称初始化？？谁TM会这么用？)
     """
 
+    # 不可变对象：数组只读，不能设置属性，哈希值在初始化时求出
+    __slots__ = ('_lattice', '_positions', '_atoms', '_atom_numbers',
+                 '_key', '_hash', '_datasets', '_primitive_cells')
+
+    # 哈希和比较时坐标和晶格取到的精度
+    _decimals = 5
+
     def __init__(self, lattice, positions, atoms):
         # TODO: magmoms init setting
-        self._lattice = numpy.array(lattice).reshape((3, 3))
+        lattice = numpy.array(lattice).reshape((3, 3))
 
-        self._atom_numbers = len(atoms)
+        atom_numbers = len(atoms)
         # import pdb; pdb.set_trace()
-        self._positions = numpy.array(positions).reshape((-1, 3))
-        moded = numpy.ones_like(self._positions, dtype='intc')
-        self._positions = numpy.mod(self._positions, moded)
-        if self._positions.shape[0] != self._atom_numbers:
+        positions = numpy.array(positions).reshape((-1, 3))
+        moded = numpy.ones_like(positions, dtype='intc')
+        positions = numpy.mod(positions, moded)
+        if positions.shape[0] != atom_numbers:
             raise ValueError("When init Cell, number of atoms not equal to "
                              "number of positions.\n"
                              "CHECK YOUR INPUT!")
@@ -59,15 +142,72 @@ class Cell(object):
 
                 a.append(round(s))
 
-        self._atoms = numpy.array(a, dtype='intc')
+        atoms = numpy.array(a, dtype='intc')
         # TODO: initial with Cartesian coor
 
+        self._set_state(lattice, positions, atoms)
+        # 以symprec为键缓存spglib的对称性结果，见`_get_dataset`
+        object.__setattr__(self, '_datasets', {})
+        object.__setattr__(self, '_primitive_cells', {})
+
+    def _set_state(self, lattice, positions, atoms):
+        for arr in (lattice, positions, atoms):
+            arr.setflags(write=False)
+        object.__setattr__(self, '_lattice', lattice)
+        object.__setattr__(self, '_positions', positions)
+        object.__setattr__(self, '_atoms', atoms)
+        object.__setattr__(self, '_atom_numbers', len(atoms))
+
+        # 取整后的晶格、坐标和原子，坐标取整后为1的换为0
+        scale = 10 ** self._decimals
+        int_lattice = numpy.around(lattice * scale).astype('int64')
+        int_positions = numpy.mod(numpy.around(positions * scale).astype('int64'), scale)
+        key = (int_lattice.tobytes(), int_positions.tobytes(),
+               atoms.astype('int64').tobytes())
+        object.__setattr__(self, '_key', key)
+        # 不用内置的hash，保证不同进程、不同次运行中相同
+        digest = hashlib.sha1(b''.join(key)).hexdigest()
+        object.__setattr__(self, '_hash', int(digest[:15], 16))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cell object is immutable, "
+                             "can't set attribute {:}".format(name))
+
+    def __delattr__(self, name):
+        raise AttributeError("Cell object is immutable, "
+                             "can't delete attribute {:}".format(name))
+
+    # 用于进程间传递，对称性的缓存一起传递
+    def __getstate__(self):
+        return (self._lattice, self._positions, self._atoms,
+                self._datasets, self._primitive_cells)
+
+    def __setstate__(self, state):
+        lattice, positions, atoms, datasets, primitive_cells = state
+        self._set_state(numpy.array(lattice), numpy.array(positions), numpy.array(atoms))
+        for dataset in datasets.values():
+            if dataset is not None:
+                for value in dataset.values():
+                    if isinstance(value, numpy.ndarray):
+                        value.setflags(write=False)
+        object.__setattr__(self, '_datasets', datasets)
+        object.__setattr__(self, '_primitive_cells', primitive_cells)
+
     # For defining a immutable object
     def __hash__(self):
-        pass
+        return self._hash
+
+    def __eq__(self, other):
+        """
+        晶格、位点（按顺序）和原子在1e-5精度内相同时相等，先比较哈希值
+        """
+        if not isinstance(other, Cell):
+            return NotImplemented
+        return self._hash == other._hash and self._key == other._key
 
-    def __eq__(self):
-        pass
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
 
     @property
     def lattice(self):
@@ -112,72 +252,82 @@ class Cell(object):
         #       1. 我们是否需要把旋转合并进来？
         #       2. 针对非对角矩阵，是一样适用？ (DONE)
         # TODO: 不必是hnf矩阵 (DONE)
-        # TODO: mat必须是一个整数矩阵，做一个判断，给出异常
+        # TODO: mat必须是一个整数矩阵，做一个判断，给出异常 (DONE)
+        if not is_int_np_array(numpy.array(mat, dtype='float64')):
+            raise ValueError("Can only extend cell by an integer matrix, "
+                             "got {:}".format(mat))
+        mat = numpy.around(mat).astype('int').reshape((3, 3))
+        if round(numpy.linalg.det(mat)) == 0:
+            raise ValueError("Can't extend cell by a singular matrix {:}".format(mat.tolist()))
         lattice = numpy.matmul(mat, self._lattice)
 
         smallest_cell = numpy.matmul(self._positions, numpy.linalg.inv(mat))
         grids = self._get_mat_frac(mat)
-        list_positions = [i for i in map(
-            lambda x: x + grids, list(smallest_cell))]
-        positions_1 = numpy.concatenate(list_positions, axis=0)
+        # 每个原子依次加上所有格点
+        positions_1 = (smallest_cell[:, numpy.newaxis] + grids).reshape((-1, 3))
         positions = positions_1 - numpy.floor(positions_1)
 
-        n = abs(numpy.linalg.det(mat))
-        atoms = numpy.repeat(self._atoms, int(round(n)))
+        atoms = numpy.repeat(self._atoms, len(grids))
 
         return self.__class__(lattice, positions, atoms)
 
     def _get_mat_frac(self, mat):
         """
-        When giving mat -- a 3x3 matrix,
+        When giving mat -- a 3x3 int matrix,
         export a numpy.array represent the
         grid points between 0~1.
 
         Used in producing the new positions extended by a matrix
-        """
-        prec = 1e-5
-
-        #m = numpy.amax(    mat)
-        #_int_coor = numpy.array([i for i in product(range(m * 3), repeat=3)])
-        # 适用于hnf
 
-        # ---------------------选取一个大框包含目标框
-        # import pdb; pdb.set_trace()
-        conv = numpy.vstack((mat, numpy.array([0, 0, 0])))
-        conv = numpy.vstack((conv, mat[0] + mat[1]))
-        conv = numpy.vstack((conv, mat[0] + mat[2]))
-        conv = numpy.vstack((conv, mat[1] + mat[2]))
-        conv = numpy.vstack((conv, mat[0] + mat[1] + mat[2]))
-
-        ma = [0, 0, 0]
-        mi = [0, 0, 0]
-        for i in range(0, 3):
-            ma[i] = numpy.amax(conv[:, i])
-            mi[i] = numpy.amin(conv[:, i])
-
-        # import pdb; pdb.set_trace()
-        _int_coor = numpy.array([j for j in product(range(
-            mi[0] - 1, ma[0] + 2), range(mi[1] - 1, ma[1] + 2), range(mi[2] - 1, ma[2] + 2))])
-        # from qiusb-------------
-
-        _all_frac = numpy.matmul(_int_coor, numpy.linalg.inv(mat))
-
-        is_incell = numpy.all(
-            ((_all_frac > -prec) & (_all_frac < 1 - prec)), axis=1)
-
-        return _all_frac[numpy.where(is_incell)[0]]
+        超胞中的格点与 Z_d1 x Z_d2 x Z_d3 一一对应（d为mat的snf对角元，v -> v R mod D），
+        由 g R^-1 直接得到|det(mat)|个格点，再用整数运算平移到超胞内，不需要在大框中筛选。
+        """
+        diag, _, opR = smith_normal_form(mat)
+        det = int(round(numpy.linalg.det(mat)))
+        inv_R = numpy.around(numpy.linalg.inv(opR)).astype('int')
+        adj = numpy.around(numpy.linalg.inv(mat) * det).astype('int')
+
+        points = numpy.matmul(numpy.indices(diag).reshape((3, -1)).T, inv_R)
+        # 超胞分数坐标为 num / det，减去整数部分
+        num = numpy.matmul(points, adj)
+        shift = numpy.floor_divide(num, det)
+        num -= shift * det
+        points -= numpy.matmul(shift, mat)
+        # 按格点的整数坐标排序，与之前在大框中逐点筛选的顺序相同
+        order = numpy.lexsort(points.T[::-1])
+        return num[order] / float(det)
+
+    def _get_dataset(self, symprec=1e-5):
+        """
+        spglib的对称性数据，每个symprec只求一次，所有对称性相关的方法都由它给出。
+        返回的数组是只读的，spglib失败时为None。
+        """
+        if symprec not in self._datasets:
+            dataset = spglib.get_symmetry_dataset(
+                (self._lattice, self._positions, self._atoms), symprec)
+            if dataset is not None:
+                for value in dataset.values():
+                    if isinstance(value, numpy.ndarray):
+                        value.setflags(write=False)
+            self._datasets[symprec] = dataset
+        return self._datasets[symprec]
 
     def get_symmetry(self, symprec=1e-5):
         """
         dependent on spglib https://atztogo.github.io/spglib/
         """
-        return spglib.get_symmetry((self._lattice, self._positions, self._atoms), symprec)
+        dataset = self._get_dataset(symprec)
+        if dataset is None:
+            return None
+        return {'rotations': dataset['rotations'],
+                'translations': dataset['translations'],
+                'equivalent_atoms': dataset['equivalent_atoms']}
 
     def get_rotations(self, symprec=1e-5):
         """
         dependent on spglib https://atztogo.github.io/spglib/
         """
-        return spglib.get_symmetry((self._lattice, self._positions, self._atoms), symprec)['rotations']
+        return self.get_symmetry(symprec)['rotations']
 
     def get_rotations_without_inversion(self, symprec=1e-5):
         """
@@ -185,9 +335,14 @@ class Cell(object):
         """
         rot_list = self.get_rotations(symprec)
         rot_list_noinv = []
+        # R和-R（R乘以反演）只保留先出现的一个
+        seen = set()
         for rot in rot_list:
-            if self._not_contain(rot_list_noinv, rot):
+            key = tuple(rot.ravel())
+            if key not in seen:
                 rot_list_noinv.append(rot)
+                seen.add(key)
+                seen.add(tuple(-rot.ravel()))
         return rot_list_noinv
 
     def get_rotations_without_transitions(self, symprec=1e-5):
@@ -215,21 +370,14 @@ class Cell(object):
         # return numpy.unique(trans_all, axis=0)
         return self.get_symmetry(symprec)['translations']
 
-    def _not_contain(self, rot_list_noinv, rot):
-        sym_inv = numpy.array([-1, 0, 0,
-                               0, -1, 0,
-                               0, 0, -1]).reshape((3, 3))
-        for r in rot_list_noinv:
-            rot_inv = numpy.matmul(rot, sym_inv)
-            if numpy.allclose(r, rot) or numpy.allclose(r, rot_inv):
-                return False
-        return True
-
     def get_spacegroup(self, symprec=1e-5):
         """
         dependent on spglib https://atztogo.github.io/spglib/
         """
-        return spglib.get_spacegroup((self._lattice, self._positions, self._atoms), symprec)
+        dataset = self._get_dataset(symprec)
+        if dataset is None:
+            return None
+        return "{:s} ({:d})".format(dataset['international'], dataset['number'])
 
     def is_primitive(self, symprec=1e-5):
         """
@@ -242,17 +390,21 @@ class Cell(object):
 
         return: bool
         """
-        natoms = len(self.atoms)
-        spg_cell = (self.lattice, self.positions, self.atoms)
-        pnatoms = len(spglib.find_primitive(spg_cell, symprec)[2])
-        return natoms == pnatoms
+        # 原胞中只有恒等操作一个纯平移
+        identity = numpy.eye(3, dtype='intc')
+        rots = self.get_rotations(symprec)
+        return numpy.count_nonzero(numpy.all(rots == identity, axis=(1, 2))) == 1
 
     def get_primitive_cell(self, symprec=1e-5):
-        spg_cell = (self.lattice, self.positions, self.atoms)
-        # 用下面这个原胞会改变坐标轴，no_idealize=True保持了坐标的方向。
-        # lattice, positions, atoms = spglib.find_primitive(spg_cell, symprec)
-        lattice, positions, atoms = spglib.standardize_cell(
-            spg_cell, to_primitive=True, no_idealize=True, symprec=symprec)
+        # 不能由对称性数据直接得到（no_idealize），每个symprec只调用一次
+        if symprec not in self._primitive_cells:
+            spg_cell = (self.lattice, self.positions, self.atoms)
+            # 用下面这个原胞会改变坐标轴，no_idealize=True保持了坐标的方向。
+            # lattice, positions, atoms = spglib.find_primitive(spg_cell, symprec)
+            lattice, positions, atoms = spglib.standardize_cell(
+                spg_cell, to_primitive=True, no_idealize=True, symprec=symprec)
+            self._primitive_cells[symprec] = (lattice, positions, atoms)
+        lattice, positions, atoms = self._primitive_cells[symprec]
         return self.__class__(lattice, positions, atoms)
 
     def _get_niggli_2D(self, vacc=16.0, eps=1e-5):
@@ -267,9 +419,9 @@ class Cell(object):
         M_3D = numpy.around(M_3D).astype(int)
         reduced_cell = self.extend(M_3D)
 
-        lattice = reduced_cell.lattice
+        lattice = reduced_cell.lattice.copy()
         lattice[2, 2] = vacc
-        positions = reduced_cell.positions
+        positions = reduced_cell.positions.copy()
         positions[:, 2] = 0.5
         atoms = reduced_cell.atoms
 
@@ -289,28 +441,42 @@ class Cell(object):
         lattice, positions, atoms = spglib.refine_cell(spg_cell, symprec)
         return self.__class__(lattice, positions, atoms)
 
+    def get_neighbor_list(self, cutoff):
+        """
+        周期性边界条件下距离不大于cutoff的所有原子对，每对只出现一次，
+        包括原子与自身的周期性像，见`neighbor_list`。
+
+        return:
+
+        pairs: (M, 2) int numpy.ndarray, 原子序号 (i, j)
+        distances: (M,) numpy.ndarray
+        images: (M, 3) int numpy.ndarray, j的像，距离矢量为 (positions[j] + image - positions[i]) * lattice
+        """
+        idx_i, idx_j, images, distances = neighbor_list(self._lattice, self._positions, cutoff)
+        # (i, j, n)与(j, i, -n)为同一对，保留i < j，i == j时保留n的字典序为正的一个
+        positive = numpy.zeros(len(images), dtype='bool')
+        undecided = numpy.ones(len(images), dtype='bool')
+        for k in range(3):
+            positive |= undecided & (images[:, k] > 0)
+            undecided &= images[:, k] == 0
+        keep = (idx_i < idx_j) | ((idx_i == idx_j) & positive)
+        pairs = numpy.stack((idx_i[keep], idx_j[keep]), axis=1)
+        return pairs, distances[keep], images[keep]
+
     def check(self, elements=None, limit=0.1, warn=False):
         """
         该方法用于自查对象中的位点是否过近
         若过近则抛出一个warning
         """
         if elements is None:
-            origin_cell = self
+            positions = self.positions
         else:
-            # 选取要check的元素，构建新的胞
+            # 选取要check的元素
             ele_num = [symbol2number(s) for s in elements]
-            positions = []
-            atoms = []
-            for idx, e in enumerate(self.atoms):
-                if e in ele_num:
-                    positions.append(self.positions[idx])
-                    atoms.append(self.atoms[idx])
-            origin_cell = self.__class__(self.lattice, positions, atoms)
-
-        mat = numpy.diag([3, 3, 3])
-        periodic_cell = origin_cell.extend(mat)
-        points = frac_to_car(periodic_cell.lattice, periodic_cell.positions)
-        if closest_pair(points) < limit:
+            positions = self.positions[numpy.isin(self.atoms, ele_num)]
+
+        _, _, _, distances = neighbor_list(self.lattice, positions, limit)
+        if numpy.any(distances < limit):
             if warn is True:
                 import warnings
                 warnings.warn("some atoms are too close(< {:f}), check cell".format(
@@ -321,7 +487,7 @@ class Cell(object):
 
 # 该类用于可以变换的结构
 # TODO: 与上面的不可变的类同时继承于固定的基类
-# TODO: 上面的类明确为不可变的类
+# TODO: 上面的类明确为不可变的类 (DONE)
 
 
 class MutableCell(object):
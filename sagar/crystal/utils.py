@@ -6,7 +6,8 @@ from math import sqrt
 from itertools import product
 
 from sagar.crystal.structure import Cell
-from sagar.toolkit.mathtool import is_int_np_array, extended_gcd
+from sagar.crystal.cache import get_cache
+from sagar.toolkit.mathtool import is_int_np_array, extended_gcd, smith_normal_form
 
 
 def _factor(n):
@@ -25,29 +26,140 @@ def _factor(n):
 
 
 def _hnfs(det):
-    h = []
+    for hnf in _hnfs_array(det):
+        yield hnf
+
+
+def _hnfs_2D(det):
+    for hnf in _hnfs_2D_array(det):
+        yield hnf
+
+
+def _hnfs_array(det):
+    """
+    行列式为det的所有hnf，(N, 3, 3) int numpy.ndarray，顺序与逐个产生时相同:
+    [[a, b, c], [0, d, e], [0, 0, f]], a*d*f = det, 0 <= b < d, 0 <= c, e < f
+    """
+    blocks = []
     for a in _factor(det):
         for d in _factor(det // a):
             f = det // a // d
+            b, c, e = (i.ravel() for i in numpy.indices((d, f, f)))
+            block = numpy.zeros((d * f * f, 3, 3), dtype='int')
+            block[:, 0, 0], block[:, 0, 1], block[:, 0, 2] = a, b, c
+            block[:, 1, 1], block[:, 1, 2] = d, e
+            block[:, 2, 2] = f
+            blocks.append(block)
+    return numpy.concatenate(blocks)
 
-            for b, c, e in product(range(d), range(f), range(f)):
-                yield numpy.array([[a, b, c],
-                                   [0, d, e],
-                                   [0, 0, f]])
 
-
-def _hnfs_2D(det):
-    # 二维的hnf矩阵生成,z方向为1
-    h = []
+def _hnfs_2D_array(det):
+    """
+    二维的hnf矩阵，z方向为1，(N, 3, 3) int numpy.ndarray
+    """
+    blocks = []
     for a in _factor(det):
         d = det // a
-        for b in range(d):
-            yield numpy.array([[a, b, 0],
-                               [0, d, 0],
-                               [0, 0, 1]])
+        block = numpy.zeros((d, 3, 3), dtype='int')
+        block[:, 0, 0], block[:, 0, 1] = a, numpy.arange(d)
+        block[:, 1, 1], block[:, 2, 2] = d, 1
+        blocks.append(block)
+    return numpy.concatenate(blocks)
 
 
-def non_dup_hnfs(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5):
+def count_hnfs(volume, dimension=3):
+    """
+    行列式为volume的hnf的个数（即指标为volume的子格子个数），由因子分解直接求出，
+    三维为 sum(d * f**2) (a*d*f = volume)，二维为 sum(d) (a*d = volume)。
+
+    parameters:
+
+    volume: int, det of hnfs
+    dimension: int, 3(default) or 2
+
+    return: int
+    """
+    if dimension == 3:
+        return sum(d * (volume // a // d) ** 2
+                   for a in _factor(volume) for d in _factor(volume // a))
+    elif dimension == 2:
+        return sum(_factor(volume))
+    else:
+        raise ValueError("Dimension you provide is not as expected."
+                         "You can only use dimension = 3(default) or 2.")
+
+
+def count_non_dup_hnfs(pcell, volume=1, dimension=3, symprec=1e-5):
+    """
+    不产生超胞，给出`non_dup_hnfs`结果的个数。
+
+    由Burnside引理，非重复的hnf个数为各旋转下不变的hnf个数的平均值。
+    不变的hnf个数在共轭类中相同，每个共轭类只需数一次。
+
+    parameters:
+
+    pcell: Cell object, The primitive cell to be extended
+    volume: int, Extend to how large supercellself, default=1
+    dimension: int, 3(default) or 2
+    symprec: float, symmetry precision
+
+    return: int
+    """
+    if not isinstance(pcell, Cell):
+        raise TypeError("Can't make hnf cells of {:} "
+                        "please provide sagar.crystal.structure.Cell object.".format(type(pcell)))
+    if not pcell.is_primitive(symprec):
+        raise ValueError("cell object you provide is not a primitive cell "
+                         "Therefore meaningless to get non duplicated hnf cells "
+                         "You can use pcell.get_primitive() first.")
+    if dimension == 3:
+        hnfs = _hnfs_array(volume)
+    elif dimension == 2:
+        hnfs = _hnfs_2D_array(volume)
+    else:
+        raise ValueError("Dimension you provide is not as expected."
+                         "You can only use dimension = 3(default) or 2.")
+
+    # 去掉反演后的旋转是 G/{E, -E} 的代表元，-E 不改变任何格子
+    rot_invs = _rotation_inverses(pcell.get_rotations_without_inversion(symprec))
+    if dimension == 2:
+        # 只有保持面内和z方向的旋转把二维的hnf变为二维的hnf
+        keep = numpy.all(rot_invs[:, :2, 2] == 0, axis=1) & numpy.all(rot_invs[:, 2, :2] == 0, axis=1)
+        rot_invs = rot_invs[keep]
+
+    total = 0
+    for rot_inv, size in _conjugacy_classes(rot_invs):
+        fixed = _hnf_reduce_batch(numpy.matmul(hnfs, rot_inv))
+        total += size * numpy.count_nonzero(numpy.all(fixed == hnfs, axis=(1, 2)))
+    return total // len(rot_invs)
+
+
+def _conjugacy_classes(rots):
+    """
+    整数旋转矩阵（相差一个符号视为相同）组成的群的共轭类
+
+    return: list of (代表元, 共轭类的大小)
+    """
+    def key(m):
+        m = m.ravel()
+        # 相差一个符号的矩阵取第一个非零元为正的一个
+        return tuple(m * numpy.sign(m[numpy.nonzero(m)[0][0]]))
+
+    rots = numpy.asarray(rots)
+    rot_invs = numpy.around(numpy.linalg.inv(rots)).astype('int')
+    classes = []
+    seen = set()
+    for rot in rots:
+        if key(rot) in seen:
+            continue
+        conj = set(key(m) for m in numpy.matmul(numpy.matmul(rots, rot), rot_invs))
+        seen.update(conj)
+        classes.append((rot, len(conj)))
+    return classes
+
+
+def non_dup_hnfs(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5,
+                 min_distance=None, max_aspect=None, most_cubic=None):
     """
     hnf_cells return all non duplicated hnf extend cells.
 
@@ -59,6 +171,11 @@ def non_dup_hnfs(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5):
     When finding duplicated hnfs the precesion, default=5
     comprec: float, compare precision
     When finding the rotations symmetry of primitive cell, defalut=1e-5
+    min_distance: float, 超胞中原子与其周期性像的最小距离（最短的超胞格矢）不小于该值，default=None
+    max_aspect: float, 超胞最长与最短的约化格矢长度之比不大于该值，default=None
+    most_cubic: int, 只保留最接近立方（最短格矢最长）的most_cubic个超胞，default=None
+    形状由超胞的格矢在生成hnf时直接求出，不需要扩胞，见`hnf_shapes`。
+    二维时只考虑面内的格矢。
 
     return:
 
@@ -68,38 +185,249 @@ def non_dup_hnfs(pcell, volume=1, dimension=3, symprec=1e-5, comprec=1e-5):
         raise TypeError("Can't make hnf cells of {:} "
                         "please provide sagar.crystal.structure.Cell object.".format(type(pcell)))
 
+    # 相同母体结构和体积的结果从磁盘缓存中读取，见`sagar.crystal.cache`
+    cache = get_cache()
+    if cache is not None:
+        key = cache.key('non_dup_hnfs', pcell, symprec, volume, dimension, comprec,
+                        min_distance, max_aspect, most_cubic)
+        cached = cache.load(key)
+        if cached is not None:
+            return list(cached['hnfs'])
+        hnfs = _non_dup_hnfs(pcell, volume, dimension, symprec, comprec,
+                             min_distance, max_aspect, most_cubic)
+        cache.save(key, hnfs=numpy.array(hnfs, dtype='int').reshape((-1, 3, 3)))
+        return hnfs
+    return _non_dup_hnfs(pcell, volume, dimension, symprec, comprec,
+                         min_distance, max_aspect, most_cubic)
+
+
+def _non_dup_hnfs(pcell, volume, dimension, symprec, comprec,
+                  min_distance=None, max_aspect=None, most_cubic=None):
     if not pcell.is_primitive(symprec):
         raise ValueError("cell object you provide is not a primitive cell "
                          "Therefore meaningless to get non duplicated hnf cells "
                          "You can use pcell.get_primitive() first.")
 
-    nodup_hnfs = []
-
     # Using rot without inversion class double speed
     # rot_list = pcell.get_rotations(symprec)
     rot_list = pcell.get_rotations_without_inversion(symprec)
     if dimension == 3:
-        for hnf in _hnfs(volume):
-            if _not_contain(nodup_hnfs, hnf, rot_list, comprec):
-                nodup_hnfs.append(hnf)
-
-        return nodup_hnfs
+        hnfs = _hnfs_array(volume)
     elif dimension == 2:
-        for hnf in _hnfs_2D(volume):
-            if _not_contain(nodup_hnfs, hnf, rot_list, comprec):
-                nodup_hnfs.append(hnf)
-
-        return nodup_hnfs
+        hnfs = _hnfs_2D_array(volume)
     else:
         raise ValueError("Dimension you provide is not as expected."
                          "You can only use dimension = 3(default) or 2.")
 
+    # 形状只与超胞的格子有关，等价的hnf形状相同，在去重之前删去不需要的形状
+    if min_distance is not None or max_aspect is not None:
+        distances, aspects = hnf_shapes(pcell, hnfs, dimension)
+        keep = numpy.ones(len(hnfs), dtype='bool')
+        if min_distance is not None:
+            keep &= distances >= min_distance - comprec
+        if max_aspect is not None:
+            keep &= aspects <= max_aspect + comprec
+        hnfs = hnfs[keep]
+    if len(hnfs) == 0:
+        return []
+
+    # 所有hnf一次求出规范形式，每种规范形式保留最先出现的hnf
+    canon = _canonical_hnfs(hnfs, rot_list)
+    _, first = numpy.unique(canon.reshape((len(hnfs), -1)), axis=0, return_index=True)
+    hnfs = hnfs[numpy.sort(first)]
+
+    if most_cubic is not None and most_cubic < len(hnfs):
+        distances, aspects = hnf_shapes(pcell, hnfs, dimension)
+        # 最短格矢越长越接近立方，相同时比较长宽比，再相同时保持原来的顺序
+        distances = numpy.around(distances / comprec)
+        aspects = numpy.around(aspects / comprec)
+        order = numpy.lexsort((numpy.arange(len(hnfs)), aspects, -distances))
+        hnfs = hnfs[numpy.sort(order[:most_cubic])]
+    return list(hnfs)
+
+
+def hnf_shapes(pcell, hnfs, dimension=3):
+    """
+    由hnf和母体的格矢求超胞的形状，不需要扩胞。
+
+    parameters:
+
+    pcell: Cell object, the primitive cell
+    hnfs: (N, 3, 3) int numpy.ndarray
+    dimension: int, 3 or 2, 二维时只考虑面内的两个格矢
+
+    return:
+
+    distances: (N,) numpy.ndarray, 超胞的最短格矢长度，即原子与其周期性像的最小距离
+    aspects: (N,) numpy.ndarray, 最长与最短的约化格矢长度之比，立方为1
+    """
+    hnfs = numpy.asarray(hnfs).reshape((-1, 3, 3))
+    bases = numpy.matmul(hnfs, pcell.lattice)[:, :dimension]
+    lengths = _minkowski_lengths(bases)
+    return lengths[:, 0], lengths[:, -1] / lengths[:, 0]
+
+
+def _minkowski_lengths(bases):
+    """
+    将(N, k, 3)的格矢同时约化为Minkowski约化基（k <= 3时各长度即逐次极小，与基的选取无关），
+    返回从小到大的长度 (N, k)。
+
+    先两两做Gauss约化（b_i -= round(b_i.b_j / b_j.b_j) * b_j），
+    再用 b_i + sum(s_j * b_j), s_j in {-1, 0, 1} 替换更长的b_i，直到没有基矢可以变短。
+    """
+    b = numpy.array(bases, dtype='float64')
+    k = b.shape[1]
+    combos = []
+    for i in range(k):
+        for s in product((-1, 0, 1), repeat=k - 1):
+            c = list(s[:i]) + [1] + list(s[i:])
+            if any(s):
+                combos.append((i, c))
+    changed = True
+    while changed:
+        changed = False
+        for i in range(k):
+            for j in range(k):
+                if i == j:
+                    continue
+                norm = numpy.einsum('ij,ij->i', b[:, j], b[:, j])
+                mu = numpy.around(numpy.einsum('ij,ij->i', b[:, i], b[:, j]) / norm)
+                if numpy.any(mu != 0):
+                    b[:, i] -= mu[:, numpy.newaxis] * b[:, j]
+                    changed = True
+        norms = numpy.einsum('ijk,ijk->ij', b, b)
+        for i, c in combos:
+            cand = numpy.einsum('j,ijk->ik', c, b)
+            cand_norm = numpy.einsum('ij,ij->i', cand, cand)
+            # 相对的容差保证循环终止
+            shorter = cand_norm < norms[:, i] * (1 - 1e-10)
+            if numpy.any(shorter):
+                b[shorter, i] = cand[shorter]
+                norms[shorter, i] = cand_norm[shorter]
+                changed = True
+    return numpy.sort(numpy.sqrt(numpy.einsum('ijk,ijk->ij', b, b)), axis=1)
+
+
+def _rotation_inverses(rot_list):
+    """
+    每个旋转R（整数幺模矩阵）的 R^-T，精确的整数矩阵，(R, 3, 3) numpy.ndarray
+    """
+    rots = numpy.asarray(rot_list).reshape((-1, 3, 3))
+    return numpy.around(numpy.linalg.inv(numpy.transpose(rots, (0, 2, 1)))).astype('int')
+
+
+def _rotated_hnfs(hnfs, rot_list):
+    """
+    每个hnf在每个旋转下的等价hnf（H R^-T 化为hnf形式），(N, R, 3, 3) numpy.ndarray
+    """
+    rot_invs = _rotation_inverses(rot_list)
+    mats = numpy.matmul(hnfs[:, numpy.newaxis], rot_invs[numpy.newaxis])
+    return _hnf_reduce_batch(mats.reshape((-1, 3, 3))).reshape(mats.shape)
+
+
+def _canonical_hnfs(hnfs, rot_list):
+    """
+    `canonical_hnf`的批量版本，hnfs为(N, 3, 3)，返回(N, 3, 3)
+    """
+    hnfs = numpy.asarray(hnfs).reshape((-1, 3, 3))
+    rotated = _rotated_hnfs(hnfs, rot_list)
+    n, n_rots = rotated.shape[:2]
+    flat = rotated.reshape((n * n_rots, 9))
+    # 先按所属的hnf，再按字典序排序，每个hnf的第一个即为最小的
+    order = numpy.lexsort(tuple(flat[:, ::-1].T) + (numpy.repeat(numpy.arange(n), n_rots),))
+    return flat[order[::n_rots]].reshape((n, 3, 3))
+
 
-def _not_contain(hnf_list, hnf, rot_list, prec):
-    for h in hnf_list:
-        if _is_hnf_dup(hnf, h, rot_list, prec):
-            return False
-    return True
+def canonical_hnf(hnf, rot_list):
+    """
+    给出与hnf产生相同超胞（差一个母体的旋转）的所有hnf中最小的一个，
+    两个hnf等价当且仅当它们的canonical_hnf相同。
+
+    parameters:
+    hnf: 3x3 int numpy.ndarray
+    rot_list: rotations of primitive cell, see `non_dup_hnfs`
+
+    return: 3x3 int numpy.ndarray
+    """
+    return _canonical_hnfs(hnf, rot_list)[0]
+
+
+def _is_hnf_dup_batch(hnfs_x, hnf_y, rot_list):
+    """
+    `_is_hnf_dup`的批量版本：hnfs_x (N, 3, 3)中每个hnf是否与hnf_y产生相同的超胞。
+    用整数运算化为hnf形式后比较，不需要求逆和精度。
+
+    return: (N,) bool numpy.ndarray
+    """
+    hnfs_x = numpy.asarray(hnfs_x).reshape((-1, 3, 3))
+    rotated = _rotated_hnfs(hnfs_x, rot_list)
+    target = _hnf_reduce(hnf_y)
+    return numpy.any(numpy.all(rotated == target, axis=(2, 3)), axis=1)
+
+
+def _hnf_reduce(mat):
+    """
+    用整数行变换（不改变行向量张成的格子）将非奇异的3x3整数矩阵化为与`_hnfs`相同形式的hnf:
+    [[a, b, c], [0, d, e], [0, 0, f]], 0 <= b < d, 0 <= c, e < f
+    """
+    m = [[int(x) for x in row] for row in numpy.reshape(mat, (3, 3))]
+    for col in range(3):
+        # 用扩展欧几里得算法消去第col列对角元以下的元素
+        for row in range(col + 1, 3):
+            a, b = m[col][col], m[row][col]
+            if b == 0:
+                continue
+            g, s, t = extended_gcd(a, b)
+            m[col], m[row] = ([s * x + t * y for x, y in zip(m[col], m[row])],
+                              [a // g * y - b // g * x for x, y in zip(m[col], m[row])])
+        if m[col][col] < 0:
+            m[col] = [-x for x in m[col]]
+    # 对角元以上的元素对下方的对角元取模
+    for col in (1, 2):
+        for row in range(col):
+            q = m[row][col] // m[col][col]
+            m[row] = [x - q * y for x, y in zip(m[row], m[col])]
+    return numpy.array(m, dtype='int')
+
+
+def _hnf_reduce_batch(mats):
+    """
+    `_hnf_reduce`的批量版本，mats为(N, 3, 3)非奇异整数矩阵，所有矩阵同时做行变换
+    """
+    m = numpy.array(mats, dtype='int64').reshape((-1, 3, 3))
+    for col in range(3):
+        for row in range(col + 1, 3):
+            a, b = m[:, col, col], m[:, row, col]
+            g, s, t = _extended_gcd_batch(a, b)
+            # 两个元素都为零时不变
+            zero = g == 0
+            g = numpy.where(zero, 1, g)
+            s, a = numpy.where(zero, 1, s), numpy.where(zero, 1, a)
+            r_col, r_row = m[:, col].copy(), m[:, row].copy()
+            m[:, col] = s[:, numpy.newaxis] * r_col + t[:, numpy.newaxis] * r_row
+            m[:, row] = (a // g)[:, numpy.newaxis] * r_row - (b // g)[:, numpy.newaxis] * r_col
+        m[:, col] *= numpy.where(m[:, col, col] < 0, -1, 1)[:, numpy.newaxis]
+    for col in (1, 2):
+        for row in range(col):
+            q = m[:, row, col] // m[:, col, col]
+            m[:, row] -= q[:, numpy.newaxis] * m[:, col]
+    return m
+
+
+def _extended_gcd_batch(aa, bb):
+    """
+    `sagar.toolkit.mathtool.extended_gcd`的向量化版本，返回 r, s, t，r = s * aa + t * bb
+    """
+    r0, r1 = numpy.abs(aa), numpy.abs(bb)
+    x0, x1 = numpy.ones_like(r0), numpy.zeros_like(r0)
+    y0, y1 = numpy.zeros_like(r0), numpy.ones_like(r0)
+    while numpy.any(r1 != 0):
+        nz = r1 != 0
+        q = numpy.where(nz, r0 // numpy.where(nz, r1, 1), 0)
+        r0, r1 = numpy.where(nz, r1, r0), numpy.where(nz, r0 - q * r1, r1)
+        x0, x1 = numpy.where(nz, x1, x0), numpy.where(nz, x0 - q * x1, x1)
+        y0, y1 = numpy.where(nz, y1, y0), numpy.where(nz, y0 - q * y1, y1)
+    return r0, x0 * numpy.where(aa < 0, -1, 1), y0 * numpy.where(bb < 0, -1, 1)
 
 
 def _is_hnf_dup(hnf_x, hnf_y, rot_list, prec=1e-5):
@@ -138,10 +466,28 @@ def snf(mat):
     opL: left operation
     opR: right operation
     """
-    mat = numpy.array(mat).reshape((3, 3))
-    intmat = IntMat3x3(mat)
-    snf_D, snf_S, snf_T = intmat.get_snf()
-    return snf_D, snf_S, snf_T
+    D, L, R = smith_normal_form(numpy.array(mat).reshape((3, 3)))
+    return numpy.diag(D), numpy.array(L, dtype='int'), numpy.array(R, dtype='int')
+
+
+def snf_batch(mats):
+    """
+    一组3x3整数矩阵的Smith Normal Form，D = L * mat * R
+
+    parameter:
+    mats: (N, 3, 3) int numpy.ndarray
+
+    return:
+    diags: (N, 3) int numpy.ndarray, 对角元，d1 | d2 | d3
+    opL, opR: (N, 3, 3) int numpy.ndarray
+    """
+    mats = numpy.asarray(mats).reshape((-1, 3, 3))
+    diags = numpy.zeros((len(mats), 3), dtype='int')
+    opL = numpy.zeros((len(mats), 3, 3), dtype='int')
+    opR = numpy.zeros((len(mats), 3, 3), dtype='int')
+    for i, mat in enumerate(mats.tolist()):
+        diags[i], opL[i], opR[i] = smith_normal_form(mat)
+    return diags, opL, opR
 
 
 class IntMat3x3(object):
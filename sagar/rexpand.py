@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
 import click
 import time
 import threading
 import sys
 
-from sagar.crystal.derive import cells_nonredundant, ConfigurationGenerator
+from sagar.crystal.derive import cells_nonredundant, ConfigurationGenerator, read_checkpoint
 from sagar.io.vasp import read_vasp, write_vasp
 from sagar.crystal.structure import symbol2number as s2n
 
@@ -29,9 +30,15 @@ def cli():
               help="Symmetry precision to decide the symmetry of primitive cell. Default=1e-5")
 @click.option('--comprec', '-p', type=float, default=1e-5,
               help="Compare precision to judging if supercell is redundant. Defalut=1e-5")
+@click.option('--min-distance', type=float, default=None,
+              help="Only supercells whose shortest lattice vector (distance between periodic images) is not shorter than this. Default=None")
+@click.option('--max-aspect', type=float, default=None,
+              help="Only supercells whose ratio of longest to shortest reduced lattice vector is not larger than this. Default=None")
+@click.option('--most-cubic', type=int, default=None,
+              help="Only the given number of the most cubic supercells of each volume. Default=None")
 @click.option('--verbose', '-vvv', is_flag=True, metavar='',
               help="Will print verbose messages.")
-def cell(pcell_filename, comment, dimension, volume, symprec, comprec, verbose):
+def cell(pcell_filename, comment, dimension, volume, symprec, comprec, min_distance, max_aspect, most_cubic, verbose):
     """
     <primitive_cell_file>  Primitive cell structure file, now only vasp POSCAR version5 supported.
     """
@@ -39,18 +46,22 @@ def cell(pcell_filename, comment, dimension, volume, symprec, comprec, verbose):
     (min_v, max_v) = volume
     if min_v == -1:
         click.echo("Expanding primitive to volume {:d}".format(max_v))
-        _export_supercell(pcell, comment, dimension, max_v, symprec, comprec, verbose)
+        _export_supercell(pcell, comment, dimension, max_v, symprec, comprec, verbose,
+                          min_distance, max_aspect, most_cubic)
     else:
         for v in range(min_v, max_v + 1):
             click.echo("Expanding primitive to volume {:d}".format(v))
-            _export_supercell(pcell, comment, dimension, v, symprec, comprec, verbose)
+            _export_supercell(pcell, comment, dimension, v, symprec, comprec, verbose,
+                              min_distance, max_aspect, most_cubic)
 
 
-def _export_supercell(pcell, comment, dimension, v, symprec, comprec, verbose):
+def _export_supercell(pcell, comment, dimension, v, symprec, comprec, verbose,
+                      min_distance=None, max_aspect=None, most_cubic=None):
     spinner = Spinner()
     # spinner.start()
     cells = cells_nonredundant(
-        pcell, v, dimension, symprec=symprec, comprec=comprec)
+        pcell, v, dimension, symprec=symprec, comprec=comprec,
+        min_distance=min_distance, max_aspect=max_aspect, most_cubic=most_cubic)
     for idx, c in enumerate(cells):
         if verbose:
             print("    " + "No.{:d}: Processing".format(idx))
@@ -80,9 +91,13 @@ def _export_supercell(pcell, comment, dimension, v, symprec, comprec, verbose):
               help="Symmetry precision to decide the symmetry of cells. Default=1e-5")
 @click.option('--comprec', type=float, default=1e-5,
               help="Compare precision to judging if supercell is redundant. Defalut=1e-5")
+@click.option('--workers', '-j', type=int, default=1,
+              help="Number of processes to deal with supercells in parallel. ONLY USED WHEN --pmode=[varv|svc]. Default=1")
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help="File to record the progress. If it exists, resume from it and continue numbering the output files.")
 @click.option('--verbose', '-vvv', is_flag=True, metavar='',
               help="Will print verbose messages.")
-def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, substitutes, number,  symprec, comprec, verbose):
+def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, substitutes, number,  symprec, comprec, workers, checkpoint, verbose):
     """
     <parent_cell_file> is the parent cell to generating configurations by sites disorder.\n
     The non-primitive cell can only used as argument when '--pmode=sc'.\n
@@ -90,6 +105,11 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
     """
     cell = read_vasp(cell_filename)
     cg = ConfigurationGenerator(cell, symprec)
+    # 从检查点继续时，输出文件接着之前的编号
+    offset = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        offset = read_checkpoint(checkpoint)['count']
+        _truncate_deg('deg.txt', comment, offset)
     if pmode == 'varv' and cmode == 'vc':
         click.secho("Expanding and generating configurations: ")
         click.secho(
@@ -101,8 +121,8 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
             min_v = 1
         sites = _get_sites(list(cell.atoms), element, substitutes)
         confs = cg.cons_max_volume(
-            sites, max_v, min_volume=min_v, dimension=dimension, symprec=symprec)
-        for idx, c in enumerate(confs):
+            sites, max_v, min_volume=min_v, dimension=dimension, symprec=symprec, workers=workers, checkpoint=checkpoint)
+        for idx, c in enumerate(confs, offset):
             c = c.get_primitive_cell()
             filename = '{:s}_id{:d}'.format(comment, idx)
             write_vasp(c, filename)
@@ -117,9 +137,9 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
         (min_v, max_v) = volume
         sites = _get_sites(list(cell.atoms), element, substitutes)
         confs = cg.cons_specific_volume(
-            sites, volume=max_v, e_num=None, dimension=dimension, symprec=symprec)
+            sites, volume=max_v, e_num=None, dimension=dimension, symprec=symprec, workers=workers, checkpoint=checkpoint)
         f_deg = open('deg.txt', 'a')
-        for idx, (c, d) in enumerate(confs):
+        for idx, (c, d) in enumerate(confs, offset):
             filename = '{:s}_id{:d}'.format(comment, idx)
             write_vasp(c, filename)
             deg_line = filename + '{:10d}'.format(d) + '\n'
@@ -143,9 +163,9 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
         e_n = e_total - sum(number)    # 第一个元素的数量
         e_num = [e_n] + list(number)    # 各个元素的数量
         confs = cg.cons_specific_volume(
-            sites, volume=max_v, e_num=e_num, dimension=dimension, symprec=symprec)
+            sites, volume=max_v, e_num=e_num, dimension=dimension, symprec=symprec, workers=workers, checkpoint=checkpoint)
         f_deg = open('deg.txt', 'a')
-        for idx, (c, d) in enumerate(confs):
+        for idx, (c, d) in enumerate(confs, offset):
             filename = '{:s}_id{:d}'.format(comment, idx)
             write_vasp(c, filename)
             deg_line = filename + '{:10d}'.format(d) + '\n'
@@ -162,9 +182,9 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
         spinner.start()
         l_atoms = cell.atoms.tolist()
         sites = _get_sites(l_atoms, element, substitutes)
-        confs = cg.cons_specific_cell(sites, None, symprec=symprec)
+        confs = cg.cons_specific_cell(sites, None, symprec=symprec, checkpoint=checkpoint)
         f_deg = open('deg.txt', 'a')
-        for idx, (c, d) in enumerate(confs):
+        for idx, (c, d) in enumerate(confs, offset):
             filename = '{:s}_id{:d}'.format(comment, idx)
             write_vasp(c, filename)
             # import pdb; pdb.set_trace()
@@ -187,10 +207,10 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
         e_total = l_atoms.count(ele_n)
         e_n = e_total - sum(number)    # 第一个元素的数量
         e_num = [e_n] + list(number)    # 各个元素的数量
-        confs = cg.cons_specific_cell(sites, e_num, symprec=symprec)
+        confs = cg.cons_specific_cell(sites, e_num, symprec=symprec, checkpoint=checkpoint)
         f_deg = open('deg.txt', 'a')
         # TODO f.close()
-        for idx, (c, d) in enumerate(confs):
+        for idx, (c, d) in enumerate(confs, offset):
             filename = '{:s}_id{:d}'.format(comment, idx)
             write_vasp(c, filename)
             deg_line = filename + '{:10d}'.format(d) + '\n'
@@ -204,6 +224,32 @@ def conf(cell_filename, comment, pmode, cmode, dimension, volume, element, subst
             pmode, cmode), bold=True, bg='red', fg='white')
 
 
+def _truncate_deg(filename, comment, offset):
+    """
+    从检查点继续时，上次最后一次保存之后输出的构型会重新输出，
+    删去deg.txt末尾这些构型（编号从offset开始）的行
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename) as f:
+        lines = f.readlines()
+
+    def is_line_of(line, idx):
+        prefix = '{:s}_id{:d}'.format(comment, idx)
+        rest = line[len(prefix):].rstrip('\n')
+        return line.startswith(prefix) and rest.strip().isdigit() \
+            and rest == '{:10d}'.format(int(rest))
+
+    # 末尾依次为编号offset, offset+1, ...的行
+    for start in range(len(lines)):
+        if all(is_line_of(line, offset + i) for i, line in enumerate(lines[start:])):
+            break
+    else:
+        return
+    with open(filename, 'w') as f:
+        f.writelines(lines[:start])
+
+
 def _get_sites(l_atoms, ele, l_sub):
     ele_n = s2n(ele)
     l_sub_n = [s2n(sub_n) for sub_n in l_sub]
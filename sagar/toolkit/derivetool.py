@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
+import bisect
+import random
 import numpy
-from itertools import product
 
-from sagar.toolkit.mathtool import binomialCoeff
+def remove_redundant(mol_positions, sites, perms, e_num=None, method='jshash', key='int'):
+    """
+    给出所有不等价的构型及其简并度
 
-def remove_redundant(mol_positions, sites, perms, e_num=None, method='jshash'):
+    method:
+        'jshash': 记录所有已出现构型的键，输出每个轨道中最先出现的排列
+        'ccsort': 有序枚举，只输出轨道中字典序最小的排列，内存占用为常数
+    """
     if method == 'jshash':
-        for i in remove_redundant_by_hash(mol_positions, sites, perms, e_num):
+        for i in remove_redundant_by_hash(mol_positions, sites, perms, e_num, key):
             yield i
-    if method == 'ccsort':
-        pass
+    elif method == 'ccsort':
+        for i in remove_redundant_by_order(mol_positions, sites, perms, e_num):
+            yield i
+    else:
+        raise ValueError(
+            "method should be 'jshash' or 'ccsort', got {:}".format(method))
 
-def remove_redundant_by_hash(mol_positions, sites, perms, e_num):
+def remove_redundant_by_hash(mol_positions, sites, perms, e_num, key='int'):
     """
     输入一个分子坐标`mol_positions`
     和每个坐标位点上的可能取代情况`sites`
@@ -19,7 +29,11 @@ def remove_redundant_by_hash(mol_positions, sites, perms, e_num):
 
     options:
         位点上元素的比例`e_num`
+        构型键的类型`key`: 'int' 将排列打包为定长整数（默认），
+            'str' 为原来的字符串键
     """
+    if key not in ('int', 'str'):
+        raise ValueError("key should be 'int' or 'str', got {:}".format(key))
     # perms = self._get_perms_from_rots_and_trans(rots, trans)
     # TODO: 加入一个机制，来清晰的设定位点上无序的状态
     sites = numpy.array(sites)
@@ -27,6 +41,31 @@ def remove_redundant_by_hash(mol_positions, sites, perms, e_num):
     # redundant configurations do not want see again
     # 用于记录在操作作用后已经存在的构型排列，而无序每次都再次对每个结构作用所有操作
     redundant = set()
+    base = max(arg_sites)
+
+    # 简并度为|G|/|stabilizer|，置换操作不能重复
+    perms = numpy.unique(numpy.asarray(perms), axis=0)
+
+    if key == 'int':
+        # 按块批量处理：先用redundant过滤，再对剩余的排列一次作用全部置换
+        block_size = _block_size(len(perms), len(arg_sites))
+        for arr_block in _atoms_blocks(arg_sites, e_num, block_size):
+            own = _pack_atoms(arr_block, base)
+            ahashes = _hashable_keys(own)
+            idx = [i for i, h in enumerate(ahashes) if h not in redundant]
+            if not idx:
+                continue
+            words = transmuted_keys(arr_block[idx], perms, base)
+            degs = _orbit_sizes(words, own[idx])
+            for i, w, deg in zip(idx, words, degs):
+                if ahashes[i] in redundant:
+                    # 与同一块中之前的排列属于同一轨道
+                    continue
+                redundant.update(_hashable_keys(w))
+                atoms = _mark_to_atoms(arr_block[i], sites)
+                m = (mol_positions, atoms)
+                yield (m, int(deg))
+        return
 
     # deg_total = 0
     # loop over configurations
@@ -37,15 +76,14 @@ def remove_redundant_by_hash(mol_positions, sites, perms, e_num):
         if ahash in redundant:
             continue
         else:
-            list_all_transmuted = []
+            n_stabilizer = 0
             for p in perms:
                 atoms_transmuted = arr_atoms_mark[p]
                 redundant.add(_hash_atoms(atoms_transmuted))
                 # degeneracy
-                list_all_transmuted.append(atoms_transmuted)
-
-            arr_all_transmuted = numpy.array(list_all_transmuted)
-            deg = numpy.unique(arr_all_transmuted, axis=0).shape[0]
+                if numpy.array_equal(atoms_transmuted, arr_atoms_mark):
+                    n_stabilizer += 1
+            deg = len(perms) // n_stabilizer
 
             atoms = _mark_to_atoms(arr_atoms_mark, sites)
 
@@ -54,46 +92,590 @@ def remove_redundant_by_hash(mol_positions, sites, perms, e_num):
             m = (mol_positions, atoms)
             yield (m, deg)
 
+
+def remove_redundant_by_order(mol_positions, sites, perms, e_num, start=0, stop=None, translations=None):
+    """
+    有序（规范代表元）枚举：一个排列当且仅当它是其轨道中字典序最小的排列时被保留。
+    每个排列的判断只依赖于它自身和`perms`，不需要记录已经出现过的构型，
+    因此内存占用与枚举规模无关。
+
+    参数与`remove_redundant_by_hash`相同。
+    可以只处理序号在[start, stop)之间的排列（见`_atoms_blocks`）。
+    不同的序号区间可以分别（并行）处理，合并后即为全部不等价构型。
+
+    translations: (T, n) numpy.ndarray, 纯平移子群的置换，default=None。
+        给出时`perms`为各陪集的代表元，群为 {r[t]}，不需要完整的置换表。
+        先只用平移排除大部分非规范的排列，剩余的再作用全部群元。
+    """
+    sites = numpy.array(sites)
+    arg_sites = [len(i) for i in sites]
+    base = max(arg_sites)
+    perms = numpy.unique(numpy.asarray(perms), axis=0)
+    n_perms = len(perms)
+    if translations is not None:
+        translations = numpy.unique(numpy.asarray(translations), axis=0)
+        n_perms *= len(translations)
+
+    block_size = _block_size(n_perms, len(arg_sites))
+    for arr_block in _atoms_blocks(arg_sites, e_num, block_size, start, stop):
+        own = _pack_atoms(arr_block, base)
+        if translations is not None:
+            words = transmuted_keys(arr_block, translations, base)
+            idx = numpy.flatnonzero(~numpy.any(_lex_less(words, own[:, numpy.newaxis]), axis=-1))
+            arr_block, own = arr_block[idx], own[idx]
+            words = _pack_atoms(arr_block[:, perms][:, :, translations], base)
+            words = words.reshape(len(arr_block), n_perms, words.shape[-1])
+        else:
+            words = transmuted_keys(arr_block, perms, base)
+        # 没有任何变换后的排列比自身的字典序更小
+        is_canon = ~numpy.any(_lex_less(words, own[:, numpy.newaxis]), axis=-1)
+        idx = numpy.flatnonzero(is_canon)
+        degs = _orbit_sizes(words[idx], own[idx])
+        for i, deg in zip(idx, degs):
+            atoms = _mark_to_atoms(arr_block[i], sites)
+            m = (mol_positions, atoms)
+            yield (m, int(deg))
+
+
+def split_ranks(e_num, n_shards, start=0):
+    """
+    将给定浓度下所有排列的序号（从start开始）均匀地分为n_shards个区间
+
+    return: list of (start, stop)
+    """
+    total = num_arrangements(e_num)
+    left = max(total - start, 0)
+    n_shards = max(min(n_shards, left), 1)
+    bounds = [start + left * i // n_shards for i in range(n_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def num_labelings(sites, e_num=None):
+    """
+    所有可能的原子排列的数目，即`remove_redundant_by_order`中序号的范围
+    """
+    if e_num is not None:
+        return num_arrangements(e_num)
+    total = 1
+    for i in sites:
+        total *= len(i)
+    return total
+
+
+def sample_configurations(mol_positions, sites, perms, n_samples, e_num=None, uniform=False, seed=None):
+    """
+    随机抽取n_samples个互不等价的构型及其简并度，用于构型数目极大、无法全部枚举的情况。
+    不枚举全部排列，也不记录已出现构型的轨道，只记录已抽到的构型的规范键。
+    输出的排列为规范形式（轨道中字典序最小的排列），与'ccsort'方法的输出一致。
+
+    uniform:
+        False: 随机选取排列的序号，再取其规范形式。
+            构型被抽到的概率正比于其简并度，与全部排列中的权重相同。
+        True: Burnside过程，以正比于|Fix(g)|的概率选取置换g，
+            再在g下不变的排列中均匀地抽取一个并取其规范形式。
+            每个不等价构型被抽到的概率相同。
+    seed: 随机数种子，相同的种子给出相同的抽样，default=None
+
+    不等价构型的总数少于n_samples时，输出全部不等价构型。
+    已抽到的构型会被跳过，所以n_samples接近总数时抽样会变慢。
+    """
+    sites = numpy.array(sites)
+    arg_sites = [len(i) for i in sites]
+    base = max(arg_sites)
+    perms = numpy.unique(numpy.asarray(perms), axis=0)
+    rng = random.Random(seed)
+
+    n_samples = min(n_samples, count_configurations(sites, perms, e_num))
+    if uniform:
+        draw = _burnside_sampler(perms, arg_sites, e_num, rng)
+    else:
+        draw = _rank_sampler(arg_sites, e_num, rng)
+
+    block_size = _block_size(len(perms), len(arg_sites))
+    sampled = set()
+    while len(sampled) < n_samples:
+        arr_block = draw(min(block_size, n_samples - len(sampled)))
+        labels, canon, degs = canonical_labels(arr_block, perms, base)
+        for row, h, deg in zip(labels, _hashable_keys(canon), degs):
+            if h in sampled:
+                continue
+            sampled.add(h)
+            atoms = _mark_to_atoms(row, sites)
+            m = (mol_positions, atoms)
+            yield (m, int(deg))
+            if len(sampled) == n_samples:
+                return
+
+
+def _rank_sampler(args, e_num, rng):
+    """
+    返回函数draw(size)，给出size个序号均匀随机的排列
+    """
+    total = _num_ranks(args, e_num)
+    dtype = 'int64' if total <= 2 ** 63 - 1 else object
+
+    def draw(size):
+        ranks = numpy.array([rng.randrange(total) for _ in range(size)], dtype=dtype)
+        return _unrank_block(ranks, args, e_num)
+    return draw
+
+
+def _burnside_sampler(perms, args, e_num, rng):
+    """
+    返回函数draw(size)，给出size个Burnside过程抽取的排列：
+    置换g被选中的概率正比于|Fix(g)|，再在Fix(g)中均匀抽取。
+    这样得到的排列所在的轨道服从均匀分布。
+    """
+    all_cycles = []
+    weights = []
+    for p in perms:
+        cycles = [(c, min(args[i] for i in c)) for c in _cycles(p)]
+        all_cycles.append(cycles)
+        weights.append(_count_fixed(tuple(sorted((len(c), k) for c, k in cycles)), e_num))
+    cumulative = []
+    total = 0
+    for w in weights:
+        total += w
+        cumulative.append(total)
+    stages = {}
+
+    def draw(size):
+        block = numpy.zeros((size, len(args)), dtype='uint8')
+        for row in block:
+            g = bisect.bisect_right(cumulative, rng.randrange(total))
+            if e_num is None:
+                for c, k in all_cycles[g]:
+                    row[c] = rng.randrange(k)
+                continue
+            cycles = [c for c, k in all_cycles[g] if k > 1]
+            if g not in stages:
+                stages[g] = _fixed_stages(cycles, e_num)
+            _sample_fixed(row, cycles, stages[g], rng)
+        return block
+    return draw
+
+
+def _fixed_stages(cycles, e_num):
+    """
+    与`_count_fixed`相同的动态规划，保留每一步的结果：
+    第i项为前i个轮换选定元素后，{各元素剩余数目: 方式数}
+    """
+    stages = [{tuple(e_num): 1}]
+    for c in cycles:
+        ways = {}
+        for left, w in stages[-1].items():
+            for j, n in enumerate(left):
+                if n >= len(c):
+                    new_left = left[:j] + (n - len(c),) + left[j + 1:]
+                    ways[new_left] = ways.get(new_left, 0) + w
+        stages.append(ways)
+    return stages
+
+
+def _sample_fixed(row, cycles, stages, rng):
+    """
+    从最后一个轮换开始倒推，均匀地抽取一个各元素恰好用完的选择，写入row
+    """
+    (e_num,) = stages[0]
+    left = (0,) * len(e_num)
+    for i in range(len(cycles) - 1, -1, -1):
+        length = len(cycles[i])
+        choices = []
+        for j in range(len(left)):
+            prev = left[:j] + (left[j] + length,) + left[j + 1:]
+            w = stages[i].get(prev, 0)
+            if w > 0:
+                choices.append((j, prev, w))
+        r = rng.randrange(sum(w for _, _, w in choices))
+        for j, prev, w in choices:
+            if r < w:
+                break
+            r -= w
+        row[cycles[i]] = j
+        left = prev
+
+
+def count_configurations(sites, perms, e_num=None):
+    """
+    不枚举构型，直接给出不等价构型的数目。
+
+    Algorithm:
+    Burnside 引理：不等价构型数 = 1/|G| * sum_g |Fix(g)|，
+    置换g下不变的排列在g的每个轮换上取相同的元素。
+    给定浓度`e_num`时，|Fix(g)|为多项式 prod_c (x_1^|c| + ... + x_k^|c|)
+    中单项式 x^e_num 的系数（带权的Pólya计数）。
+
+    parameters:
+    sites: 每个位点上可能的取代情况，与`remove_redundant`相同
+    perms: 置换操作，需构成一个群
+    e_num: None or tuple, 无序位点上各元素的数目
+
+    return: int
+    """
+    arg_sites = [len(i) for i in sites]
+    if e_num is not None:
+        num_disorder_site = len([s for s in arg_sites if s > 1])
+        if num_disorder_site != sum(e_num):
+            raise ValueError("concentration given error, wanted sum {:d}, got {:d}".format(
+                num_disorder_site, sum(e_num)))
+    perms = numpy.unique(numpy.asarray(perms), axis=0)
+    total = 0
+    for cycle_type, n in _cycle_types(perms, arg_sites).items():
+        total += n * _count_fixed(cycle_type, e_num)
+    return total // len(perms)
+
+
+def count_configurations_all_concentrations(sites, perms):
+    """
+    一次计算所有浓度下不等价构型的数目。
+
+    Algorithm:
+    群的Pólya生成多项式 1/|G| * sum_g prod_c (x_1^|c| + ... + x_k^|c|)，
+    其中c取遍g在无序位点上的轮换，单项式 x^e_num 的系数即浓度为e_num的构型数。
+
+    parameters:
+    sites: 每个位点上可能的取代情况，所有无序位点的可取元素数必须相同
+    perms: 置换操作，需构成一个群
+
+    return:
+    dict, {e_num (tuple): 不等价构型数目 (int)}
+    """
+    arg_sites = [len(i) for i in sites]
+    disorder = set(s for s in arg_sites if s > 1)
+    if len(disorder) > 1:
+        raise ValueError("number of elements in disorderd sites should be "
+                         "the same, got {:}".format(sorted(disorder)))
+    k = disorder.pop() if disorder else 1
+    perms = numpy.unique(numpy.asarray(perms), axis=0)
+    poly = {}
+    for cycle_type, n in _cycle_types(perms, arg_sites).items():
+        for e_num, c in _fixed_polynomial(cycle_type, k).items():
+            poly[e_num] = poly.get(e_num, 0) + n * c
+    return dict((e_num, c // len(perms)) for e_num, c in poly.items())
+
+
+def _cycles(perm):
+    """
+    将一个置换分解为轮换，返回轮换（位点序号的list）的list
+    """
+    perm = list(perm)
+    visited = [False] * len(perm)
+    cycles = []
+    for i in range(len(perm)):
+        if visited[i]:
+            continue
+        cycle = []
+        j = i
+        while not visited[j]:
+            visited[j] = True
+            cycle.append(j)
+            j = perm[j]
+        cycles.append(cycle)
+    return cycles
+
+
+def _cycle_types(perms, arg_sites):
+    """
+    统计置换的轮换类型。轮换类型为(轮换长度, 位点可取元素数)的有序tuple，
+    返回 {轮换类型: 具有该类型的置换数目}
+    """
+    types = {}
+    for p in perms:
+        t = tuple(sorted((len(c), min(arg_sites[i] for i in c))
+                         for c in _cycles(p)))
+        types[t] = types.get(t, 0) + 1
+    return types
+
+
+def _count_fixed(cycle_type, e_num=None):
+    """
+    轮换类型为cycle_type的置换下不变的排列的数目
+    """
+    if e_num is None:
+        fixed = 1
+        for _, k in cycle_type:
+            fixed *= k
+        return fixed
+
+    # 动态规划：依次为每个无序位点上的轮换选择元素，记录各元素剩余的数目
+    ways = {tuple(e_num): 1}
+    for length, k in cycle_type:
+        if k == 1:
+            continue
+        new_ways = {}
+        for left, w in ways.items():
+            for j, n in enumerate(left):
+                if n >= length:
+                    new_left = left[:j] + (n - length,) + left[j + 1:]
+                    new_ways[new_left] = new_ways.get(new_left, 0) + w
+        ways = new_ways
+    return ways.get((0,) * len(e_num), 0)
+
+
+def _fixed_polynomial(cycle_type, k):
+    """
+    轮换类型为cycle_type的置换的不变排列按浓度展开，
+    即 prod_c (x_1^|c| + ... + x_k^|c|)，返回 {指数tuple: 系数}
+    """
+    poly = {(0,) * k: 1}
+    for length, n in cycle_type:
+        if n == 1:
+            continue
+        new_poly = {}
+        for exps, c in poly.items():
+            for j in range(k):
+                new_exps = exps[:j] + (exps[j] + length,) + exps[j + 1:]
+                new_poly[new_exps] = new_poly.get(new_exps, 0) + c
+        poly = new_poly
+    return poly
+
+
+def transmuted_keys(arr_labels, perms, base):
+    """
+    对(B, n)的排列块一次作用全部P个置换`arr_labels[:, perms]`，
+    得到(B, P, n)的所有变换后的排列，并整体打包为整数键。
+
+    parameters:
+    arr_labels: (B, n) numpy.ndarray, B个位点排列
+    perms: (P, n) numpy.ndarray, 置换操作
+    base: int, 每个位点上可能的取值数目
+
+    return:
+    (B, P, n_words) int64 numpy.ndarray, 见`_pack_atoms`
+    """
+    arr_labels = numpy.asarray(arr_labels)
+    return _pack_atoms(arr_labels[:, perms], base)
+
+
+def canonical_block(arr_labels, perms, base):
+    """
+    批量求一组排列的规范键（轨道中字典序最小的排列的键）和简并度。
+
+    return:
+    canon: (B, n_words) int64 numpy.ndarray, 规范键
+    degs: (B,) numpy.ndarray, 每个排列的简并度（轨道中不同排列的数目）
+    """
+    words, degs = _sort_orbit_keys(transmuted_keys(arr_labels, perms, base))
+    return words[:, 0], degs
+
+
+def canonical_labels(arr_labels, perms, base):
+    """
+    与`canonical_block`相同，另外给出规范键对应的排列本身。
+
+    return:
+    labels: (B, n) numpy.ndarray, 规范排列（轨道中字典序最小的排列）
+    canon: (B, n_words) int64 numpy.ndarray, 规范键
+    degs: (B,) numpy.ndarray, 简并度
+    """
+    arr_all = numpy.asarray(arr_labels)[:, perms]
+    words = _pack_atoms(arr_all, base)
+    idx = _orbit_order(words)
+    labels = arr_all[numpy.arange(len(arr_all)), idx[:, 0]]
+    words, degs = _sort_orbit_keys(words, idx)
+    return labels, words[:, 0], degs
+
+
+def orbit_sizes(arr_labels, perms, base):
+    """
+    批量求一组排列的简并度（轨道大小）|G| / |stabilizer|。
+    稳定子为使排列不变的置换，由变换后的键与自身的键是否相等一次判断，不需要排序。
+
+    parameters:
+    arr_labels: (B, n) numpy.ndarray, B个位点排列
+    perms: (P, n) numpy.ndarray, 置换操作，需构成一个群且没有重复
+    base: int, 每个位点上可能的取值数目
+
+    return: (B,) numpy.ndarray
+    """
+    arr_labels = numpy.asarray(arr_labels)
+    words = transmuted_keys(arr_labels, perms, base)
+    return _orbit_sizes(words, _pack_atoms(arr_labels, base))
+
+
+def _orbit_sizes(words, own):
+    """
+    words: (B, P, n_words) 变换后的键，own: (B, n_words) 自身的键
+    """
+    n_stabilizer = numpy.all(words == own[:, numpy.newaxis], axis=-1).sum(axis=-1)
+    return words.shape[1] // n_stabilizer
+
+
+def _lex_less(a, b):
+    """
+    逐个比较最后一维为n_words的键（可广播），a的字典序小于b时为True
+    """
+    a, b = numpy.broadcast_arrays(a, b)
+    diff = a != b
+    first = numpy.argmax(diff, axis=-1)[..., numpy.newaxis]
+    a_first = numpy.take_along_axis(a, first, axis=-1)[..., 0]
+    b_first = numpy.take_along_axis(b, first, axis=-1)[..., 0]
+    return diff.any(axis=-1) & (a_first < b_first)
+
+
+def _orbit_order(words):
+    """
+    将(B, P, n_words)的键沿P按字典序排序的序号
+    """
+    return numpy.lexsort(numpy.moveaxis(words[..., ::-1], -1, 0), axis=-1)
+
+
+def _sort_orbit_keys(words, idx=None):
+    """
+    将(B, P, n_words)的键沿P按字典序排序，并给出每行中不同键的数目
+    """
+    if idx is None:
+        idx = _orbit_order(words)
+    words = numpy.take_along_axis(words, idx[..., numpy.newaxis], axis=1)
+    is_new = numpy.any(words[:, 1:] != words[:, :-1], axis=-1)
+    return words, is_new.sum(axis=-1) + 1
+
+
+def _block_size(n_perms, n_sites, max_elements=2**22):
+    """
+    每块排列的数目，使得(B, P, n)的数组元素个数不超过max_elements
+    """
+    return max(max_elements // max(n_perms * n_sites, 1), 1)
+
+
+def _atoms_blocks(args, e_num=None, block_size=1024, start=0, stop=None):
+    """
+    按块产生所有可能的原子排列（见`_atoms_gen`），每块为(B, n)的uint8 numpy.ndarray。
+
+    每块排列都由其序号直接算出，不需要事先产生全部的排列，
+    因此内存占用只与block_size有关，与排列的总数无关。
+    start, stop: int, 只产生序号在[start, stop)之间的排列
+    """
+    total = _num_ranks(args, e_num)
+    if stop is None or stop > total:
+        stop = total
+    lo = start
+    while lo < stop:
+        hi = min(lo + block_size, stop)
+        yield _unrank_block(_rank_range(lo, hi, total), args, e_num)
+        lo = hi
+
+
+def _num_ranks(args, e_num=None):
+    """
+    排列序号的范围，给定浓度时检查浓度与无序位点数是否一致
+    """
+    if e_num is None:
+        total = 1
+        for i in args:
+            total *= i
+        return total
+    num_disorder_site = len([n for n in args if n > 1])
+    if num_disorder_site != sum(e_num):
+        raise ValueError("concentration given error, wanted sum {:d}, got {:d}".format(
+            num_disorder_site, sum(e_num)))
+    return num_arrangements(e_num)
+
+
+def _unrank_block(ranks, args, e_num=None):
+    """
+    一组序号对应的排列，(B, n)的uint8 numpy.ndarray
+    """
+    if e_num is None:
+        return _unrank_labelings(ranks, args)
+    disorder_cols = [col for col, n in enumerate(args) if n > 1]
+    if len(disorder_cols) == len(args):
+        return _unrank_arrangements(ranks, e_num)
+    # 若该位点只有一个元素，则该列为0
+    block = numpy.zeros((len(ranks), len(args)), dtype='uint8')
+    block[:, disorder_cols] = _unrank_arrangements(ranks, e_num)
+    return block
+
+
+def _rank_range(lo, hi, total):
+    """
+    序号数组，序号可能超过int64时使用python int (dtype=object)
+    """
+    if total <= 2 ** 63 - 1:
+        return numpy.arange(lo, hi, dtype='int64')
+    return numpy.array([lo + i for i in range(hi - lo)], dtype=object)
+
+
+def _unrank_labelings(ranks, args):
+    """
+    不限浓度时，序号按混合进制给出每个位点上的元素，最后一个位点变化最快，
+    与`itertools.product`的顺序相同
+    """
+    block = numpy.zeros((len(ranks), len(args)), dtype='uint8')
+    weight = 1
+    for col in range(len(args) - 1, -1, -1):
+        block[:, col] = (ranks // weight) % args[col]
+        weight *= args[col]
+    return block
+
+
+_UNSET = 255
+
+
+def _unrank_arrangements(ranks, e_num):
+    """
+    `unrank_arrangement`的向量化版本，一次给出一组序号对应的排列，
+    在每个位点上对所有序号同时作判断。
+    """
+    if len(e_num) >= _UNSET:
+        raise ValueError("too many elements: {:d}".format(len(e_num)))
+    slots_total = sum(e_num)
+    table = _binomial_table(slots_total)
+    comb = _radices(e_num, table)
+    # 只与 x < comb[e] 比较或相减，大于max(comb)的组合数截断为max(comb)后结果不变，
+    # 这样组合数表与序号的dtype相同，不会因为位点多而溢出
+    cap = max(comb)
+    arr_table = numpy.zeros((slots_total + 1, slots_total + 1), dtype=ranks.dtype)
+    for m, row in enumerate(table):
+        arr_table[m, :m + 1] = [min(v, cap) for v in row]
+
+    n_rows = len(ranks)
+    arr = numpy.full((n_rows, slots_total), _UNSET, dtype='uint8')
+    y = ranks
+    open_slots = slots_total
+    for e, n_color in enumerate(e_num):
+        y, x = y // comb[e], y % comb[e]
+        a = numpy.full(n_rows, n_color, dtype='int64')
+        m = numpy.full(n_rows, open_slots, dtype='int64')
+        for idx in range(slots_total):
+            is_open = arr[:, idx] == _UNSET
+            active = is_open & (a > 0)
+            if not active.any():
+                continue
+            b = arr_table[numpy.maximum(m - 1, 0), numpy.maximum(a - 1, 0)]
+            take = active & (b > x)
+            x = x - numpy.where(active & ~take, b, 0)
+            a -= take
+            arr[take, idx] = e
+            m -= is_open
+        open_slots -= n_color
+    return arr
+
+
 def _mark_to_atoms(arr_mark, sites):
     num_of_site_groups = len(sites)
     arr_atoms = arr_mark.reshape(num_of_site_groups, -1)
     # import pdb; pdb.set_trace()
-    atoms = numpy.zeros_like(arr_atoms)
+    atoms = numpy.zeros(arr_atoms.shape, dtype='int')
     for i, row in enumerate(arr_atoms):
         for j, v in enumerate(row):
             atoms[i][j] = sites[i][v]
 
     return atoms.flatten().tolist()
 
-def _atoms_gen(args, e_num=None):
+def _atoms_gen(args, e_num=None, start=0, stop=None):
     """
     parameter:
     args: list, represent number of atoms of each site.
     e_num: None or tuple, concentration of element in disorderd sites,
             default=None, for all configurations
+    start, stop: int, 只产生序号在[start, stop)之间的排列
 
-    给定每个位点原子无序的数目，产生所有可能的原子排列，共k^n种。
-    TODO: 在这里加入浓度比？
+    给定每个位点原子无序的数目，逐个产生所有可能的原子排列，共k^n种。
     """
-    if e_num is None:
-        p = []
-        for i in args:
-            p.append(range(i))
-        return product(*p)
-    else:
-        # import pdb; pdb.set_trace()
-        disorder_site = [s for s in args if s > 1]
-        num_disorder_site = len(disorder_site)
-        if num_disorder_site != sum(e_num):
-            raise ValueError("concentration given error, wanted sum {:d}, got {:d}".format(
-                num_disorder_site, sum(e_num)))
-        arr_arrange = _serial_int_to_arrangement(e_num)
-
-        # 若该位点只有一个元素，则在arr_arrange中加入指定列
-        for col, n in enumerate(args):
-            if n == 1:
-                arr_arrange = numpy.insert(arr_arrange, col, 0, axis=1)
-        return arr_arrange
+    for block in _atoms_blocks(args, e_num, 1024, start, stop):
+        for row in block:
+            yield row
 
 def _hash_atoms(atoms):
     """
@@ -101,47 +683,192 @@ def _hash_atoms(atoms):
     """
     return ''.join(str(i) for i in atoms)
 
-def _serial_int_to_arrangement(e_num):
+def _sites_per_word(base):
+    """
+    一个64位有符号整数中最多能以base进制存放的位点数
+    """
+    base = max(base, 2)
+    n = 0
+    while base ** (n + 1) <= 2 ** 63 - 1:
+        n += 1
+    return n
+
+
+def _pack_atoms(arr_atoms, base):
+    """
+    将原子排列（最后一维为位点）以base进制打包为整数，所有排列一次向量化计算。
+
+    位点按顺序由高位到低位排列，因此打包结果的大小顺序与排列的字典序一致。
+    若base^n超过64位整数的范围，则按`_sites_per_word`分段，每段一个整数。
+
+    return:
+    int64 numpy.ndarray, 形状为 arr_atoms.shape[:-1] + (n_words,)
+    """
+    arr_atoms = numpy.asarray(arr_atoms)
+    n = arr_atoms.shape[-1]
+    base = max(base, 2)
+    per_word = _sites_per_word(base)
+    n_words = max(-(-n // per_word), 1)
+    # 第一段的位点数可能不足per_word，相当于在前面补零，不改变字典序
+    bounds = [0] + list(range(n - (n_words - 1) * per_word, n + 1, per_word))
+    words = numpy.empty(arr_atoms.shape[:-1] + (n_words,), dtype='int64')
+    for j in range(n_words):
+        lo, hi = bounds[j], bounds[j + 1]
+        weights = base ** numpy.arange(hi - lo - 1, -1, -1, dtype='int64')
+        words[..., j] = numpy.dot(arr_atoms[..., lo:hi], weights)
+    return words
+
+
+def _hashable_keys(words):
+    """
+    将`_pack_atoms`的结果转换为可放入set的键：
+    单段时为python int，多段时为定长bytes。
+    """
+    if words.shape[-1] == 1:
+        return words[..., 0].tolist()
+    n_words = words.shape[-1]
+    arr = numpy.ascontiguousarray(words, dtype='>i8')
+    return arr.view('S{:d}'.format(8 * n_words))[..., 0].tolist()
+
+
+def num_arrangements(e_num):
+    """
+    给定浓度下排列的总数，即排列序号的范围
+
+    parameter:
+    e_num: tuple, 各元素在无序位点上的数目
     """
+    table = _binomial_table(sum(e_num))
+    total = 1
+    for r in _radices(e_num, table):
+        total *= r
+    return total
+
+
+def unrank_arrangement(rank, e_num):
+    """
+    unrank_arrangement 由序号得到给定浓度下的排列，是`rank_arrangement`的逆。
+
     Algorithm From:
     Hart, G. L. W., Nelson, L. J., & Forcade, R. W. (2012).
     Generating derivative structures at a fixed concentration, 59, 101–107.
+    组合数系统 (combinatorial number system)，
+    序号按混合进制依次给出每种元素在剩余空位中的组合序号。
 
     Corrections:
     Some error in paper: fig. 5 --- loop over site: should be t = t - 1
+    The serial int should be divided by comb[e] for each element in turn,
+    otherwise arrangements are duplicated when there are more than two elements.
+
+    parameters:
+    rank: int, 0 <= rank < num_arrangements(e_num)
+    e_num: tuple, 各元素在无序位点上的数目
+
+    return:
+    numpy.ndarray, 每个无序位点上元素的序号
+    """
+    slots_total = sum(e_num)
+    table = _binomial_table(slots_total)
+    comb = _radices(e_num, table)
+    _check_rank(rank, comb)
+
+    arrangement = [-1] * slots_total
+    open_slots = slots_total
+    y = rank
+    for e, a in enumerate(e_num):
+        y, x = divmod(y, comb[e])
+        m = open_slots
+        for idx in range(slots_total):
+            if a == 0:
+                break
+            if arrangement[idx] != -1:
+                # 该slot已经放置原子
+                continue
+            b = table[m - 1][a - 1]
+            if b <= x:
+                x -= b
+            else:
+                a -= 1
+                arrangement[idx] = e
+            m -= 1
+        open_slots -= e_num[e]
+    return numpy.array(arrangement)
+
+
+def rank_arrangement(arrangement, e_num):
+    """
+    rank_arrangement 给出给定浓度下一个排列的序号，是`unrank_arrangement`的逆。
+
+    parameters:
+    arrangement: 1D list or numpy.ndarray, 每个无序位点上元素的序号
+    e_num: tuple, 各元素在无序位点上的数目
+
+    return: int
+    """
+    arrangement = [int(i) for i in arrangement]
+    slots_total = sum(e_num)
+    if len(arrangement) != slots_total or \
+            any(arrangement.count(e) != n for e, n in enumerate(e_num)):
+        raise ValueError("arrangement {:} not consistent with e_num {:}".format(
+            arrangement, tuple(e_num)))
+    table = _binomial_table(slots_total)
+    comb = _radices(e_num, table)
+
+    rank = 0
+    scale = 1
+    placed = [False] * slots_total
+    open_slots = slots_total
+    for e, a in enumerate(e_num):
+        x = 0
+        m = open_slots
+        for idx in range(slots_total):
+            if a == 0:
+                break
+            if placed[idx]:
+                continue
+            if arrangement[idx] == e:
+                a -= 1
+                placed[idx] = True
+            else:
+                x += table[m - 1][a - 1]
+            m -= 1
+        rank += x * scale
+        scale *= comb[e]
+        open_slots -= e_num[e]
+    return rank
+
+
+_binomial_tables = {}
+
+
+def _binomial_table(n):
+    """
+    杨辉三角，table[m][a] = C(m, a)，0 <= a <= m <= n，均为精确的整数
+    """
+    if n not in _binomial_tables:
+        table = [[1]]
+        for m in range(1, n + 1):
+            prev = table[-1]
+            table.append([1] + [prev[a - 1] + prev[a] for a in range(1, m)] + [1])
+        _binomial_tables[n] = table
+    return _binomial_tables[n]
+
+
+def _radices(e_num, table):
+    """
+    混合进制的各位：第e种元素在剩余空位中的组合数
     """
-    slots_total = _slots_total = sum(e_num)
     comb = []
-    max = 1
+    slots = sum(e_num)
     for v in e_num:
-        bino = binomialCoeff(_slots_total, v)
-        comb.append(bino)
-        max *= bino
-        _slots_total -= v
-
-    max = int(max)
-    arr_arrangement = numpy.full((max, slots_total), -1)
-
-    for i in range(max):
-        open_slots = slots_total
-        for e in range(len(e_num)):
-            y, x = divmod(i, comb[e])
-            a = e_num[e]
-            n_color = a
-            m = open_slots
-
-            for idx, value in enumerate(arr_arrangement[i]):
-                if value != -1:
-                    # 该slot已经放置原子
-                    continue
-                else:
-                    b = binomialCoeff(m - 1, a - 1)
-                    if b <= x:
-                        x -= b
-                    else:
-                        a -= 1
-                        arr_arrangement[i][idx] = e
-                    m -= 1
-
-            open_slots -= n_color
-    return arr_arrangement
+        comb.append(table[slots][v])
+        slots -= v
+    return comb
+
+
+def _check_rank(rank, comb):
+    total = 1
+    for r in comb:
+        total *= r
+    if not 0 <= rank < total:
+        raise ValueError("rank should be in [0, {:d}), got {:d}".format(total, rank))
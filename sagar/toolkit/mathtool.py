@@ -41,6 +41,80 @@ def extended_gcd(aa, bb):
         y, lasty = lasty - quotient * y, y
     return lastremainder, lastx * (-1 if aa < 0 else 1), lasty * (-1 if bb < 0 else 1)
 
+
+def smith_normal_form(mat):
+    """
+    只用python整数计算3x3矩阵的Smith Normal Form，D = L * mat * R
+
+    parameters:
+    mat: 3x3 int matrix (nested list or numpy.ndarray)
+
+    return: 对角元list (d1 | d2 | d3), L, R，L和R为嵌套list
+
+    Algorithm:
+    每次取剩余子矩阵中绝对值最小的非零元为主元，用整数行、列变换消去主元所在的行和列，
+    余数非零时以更小的余数为主元重复；若主元不能整除子矩阵的某个元素，
+    将该行加到主元所在行后继续，最后主元整除其后所有元素。
+    """
+    A = [[int(x) for x in row] for row in mat]
+    L = [[int(i == j) for j in range(3)] for i in range(3)]
+    R = [[int(i == j) for j in range(3)] for i in range(3)]
+
+    def swap_rows(i, j):
+        A[i], A[j] = A[j], A[i]
+        L[i], L[j] = L[j], L[i]
+
+    def swap_cols(i, j):
+        for M in (A, R):
+            for row in M:
+                row[i], row[j] = row[j], row[i]
+
+    for k in range(3):
+        while True:
+            entries = [(abs(A[i][j]), i, j) for i in range(k, 3) for j in range(k, 3) if A[i][j] != 0]
+            if not entries:
+                break
+            _, i, j = min(entries)
+            swap_rows(k, i)
+            swap_cols(k, j)
+            p = A[k][k]
+            done = True
+            for i in range(k + 1, 3):
+                q = A[i][k] // p
+                A[i] = [x - q * y for x, y in zip(A[i], A[k])]
+                L[i] = [x - q * y for x, y in zip(L[i], L[k])]
+                done = done and A[i][k] == 0
+            for j in range(k + 1, 3):
+                q = A[k][j] // p
+                for M in (A, R):
+                    for row in M:
+                        row[j] -= q * row[k]
+                done = done and A[k][j] == 0
+            if not done:
+                continue
+            rest = [i for i in range(k + 1, 3) if any(A[i][j] % p for j in range(k + 1, 3))]
+            if not rest:
+                break
+            A[k] = [x + y for x, y in zip(A[k], A[rest[0]])]
+            L[k] = [x + y for x, y in zip(L[k], L[rest[0]])]
+        if A[k][k] < 0:
+            A[k] = [-x for x in A[k]]
+            L[k] = [-x for x in L[k]]
+
+    # 行列式均为-1时各变一次号，使L和R的行列式为1（D不变）
+    if _det3(L) < 0 and _det3(R) < 0:
+        L[2] = [-x for x in L[2]]
+        for row in R:
+            row[2] = -row[2]
+    return [A[0][0], A[1][1], A[2][2]], L, R
+
+
+def _det3(m):
+    return (m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1])
+            - m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0])
+            + m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0]))
+
+
 def binomialCoeff(n, k):
     if k < 0:
         return -1
@@ -48,9 +122,10 @@ def binomialCoeff(n, k):
     if n - k < k:
         k = n - k
 
+    # 连续i个整数之积能被i!整除，整数除法是精确的
     for i in range(1, k + 1):
-        result = result * (n - i + 1) / i
-    return int(result)
+        result = result * (n - i + 1) // i
+    return result
 
 
 def distance(p1, p2):
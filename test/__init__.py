@@ -2,6 +2,8 @@ import logging
 import tempfile
 import os
 
+from sagar.crystal.cache import set_cache
+
 TEST_LOG = os.path.join(tempfile.gettempdir(), 'sagar_unittest.log')
 try:
     os.remove(TEST_LOG)
@@ -9,3 +11,6 @@ except OSError:
     pass
 FORMAT = "[%(filename)s:%(lineno)s - %(funcName)s()] %(message)s"
 logging.basicConfig(filename=TEST_LOG, level=logging.INFO, format=FORMAT)
+
+# 测试不读写用户的磁盘缓存，测试的是当前的代码而不是以前缓存的结果
+set_cache(None)
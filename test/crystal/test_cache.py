@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from sagar.crystal.structure import Cell
+from sagar.crystal.cache import DiskCache, get_cache, set_cache
+from sagar.crystal.derive import PermutationGroup
+from sagar.crystal.utils import non_dup_hnfs
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old = get_cache()
+        fcc_latt = [0, 5, 5,
+                    5, 0, 5,
+                    5, 5, 0]
+        self.fcc_pcell = Cell(fcc_latt, [(0, 0, 0), (0.5, 0.5, 0.5)], [1, 2])
+
+    def tearDown(self):
+        if self.old is None:
+            set_cache(None)
+        else:
+            set_cache(self.old.directory, self.old.max_size)
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        key = DiskCache.key('non_dup_hnfs', self.fcc_pcell, 1e-5, 4)
+        self.assertEqual(key, DiskCache.key('non_dup_hnfs', self.fcc_pcell, 1e-5, 4))
+        self.assertNotEqual(key, DiskCache.key('non_dup_hnfs', self.fcc_pcell, 1e-5, 3))
+        self.assertNotEqual(key, DiskCache.key('non_dup_hnfs', self.fcc_pcell, 1e-3, 4))
+        other = Cell(self.fcc_pcell.lattice, self.fcc_pcell.positions, [1, 3])
+        self.assertNotEqual(key, DiskCache.key('non_dup_hnfs', other, 1e-5, 4))
+
+    def test_save_load_evict(self):
+        cache = DiskCache(os.path.join(self.tmpdir, 'sub'), max_size=1000)
+        self.assertIsNone(cache.load('a'))
+        cache.save('a', x=numpy.arange(10))
+        self.assertEqual(cache.load('a')['x'].tolist(), list(range(10)))
+        cache.save('b', x=numpy.arange(10))
+        os.utime(cache._filename('a'), (1, 1))
+        cache.save('c', x=numpy.arange(10))
+        # 最久未使用的项被删除
+        self.assertIsNone(cache.load('a'))
+        self.assertIsNotNone(cache.load('c'))
+        self.assertLessEqual(cache.size(), 1000)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+    def test_evict_only_over_size(self):
+        evicted = []
+
+        class Cache(DiskCache):
+            def evict(self):
+                evicted.append(True)
+                DiskCache.evict(self)
+
+        cache = Cache(self.tmpdir, max_size=1200)
+        for key in 'abc':
+            cache.save(key, x=numpy.arange(10))
+        self.assertEqual(evicted, [])
+        self.assertEqual(cache._size, cache.size())
+        cache.save('d', x=numpy.arange(10))
+        self.assertEqual(evicted, [True])
+        self.assertLessEqual(cache.size(), 1200)
+        self.assertEqual(cache._size, cache.size())
+
+    def test_disabled_in_tests(self):
+        # 见test/__init__.py
+        self.assertIsNone(self.old)
+
+    def test_non_dup_hnfs_and_perms(self):
+        set_cache(self.tmpdir)
+        wanted = non_dup_hnfs(self.fcc_pcell, 4)
+        self.assertGreater(get_cache().size(), 0)
+        got = non_dup_hnfs(self.fcc_pcell, 4)
+        self.assertEqual([h.tolist() for h in got], [h.tolist() for h in wanted])
+
+        pg = PermutationGroup(self.fcc_pcell, wanted[1])
+        perms = pg.get_symmetry_perms()
+        pg = PermutationGroup(self.fcc_pcell, wanted[1])
+        self.assertTrue(numpy.array_equal(pg.get_symmetry_perms(), perms))
+        self.assertTrue(numpy.array_equal(pg.get_symmetry_perms(method='spglib'), perms))
+
+        set_cache(None)
+        self.assertIsNone(get_cache())
+        got = non_dup_hnfs(self.fcc_pcell, 4)
+        self.assertEqual([h.tolist() for h in got], [h.tolist() for h in wanted])
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 import unittest
 import numpy
 
@@ -6,6 +9,9 @@ import spglib
 
 from sagar.crystal.structure import Cell
 from sagar.crystal.derive import ConfigurationGenerator as CG
+from sagar.crystal.derive import read_checkpoint, _Progress
+from sagar.crystal.derive import PermutationGroup, _translations_of_snf, _match_positions
+from sagar.crystal.utils import non_dup_hnfs
 
 
 class TestDerive(unittest.TestCase):
@@ -39,6 +45,27 @@ class TestDerive(unittest.TestCase):
 
         self.assertEqual(got, wanted)
 
+    def test_cons_specific_volume_ccsort(self):
+        wanted = [2, 6, 12, 41]
+        got = []
+        cg = CG(self.fcc_pcell)
+        for v in [1, 2, 3, 4]:
+            con = cg.cons_specific_volume([(1, 5), (2,)], v, method='ccsort')
+            got.append(len([i for i in con]))
+
+        self.assertEqual(got, wanted)
+
+    def test_cons_specific_volume_workers(self):
+        cg = CG(self.fcc_pcell)
+        serial = [(c.lattice.tolist(), c.atoms.tolist(), d) for c, d in
+                  cg.cons_specific_volume([(1, 5), (2,)], 4)]
+        parallel = [(c.lattice.tolist(), c.atoms.tolist(), d) for c, d in
+                    cg.cons_specific_volume([(1, 5), (2,)], 4, workers=2)]
+        self.assertEqual(parallel, serial)
+
+        got = len(list(cg.cons_max_volume([(1, 5), (2,)], 4, workers=2)))
+        self.assertEqual(got, 29)
+
     def test_cons_specific_volume_c(self):
         wanted = [7]
         got = []
@@ -99,6 +126,11 @@ class TestDerive(unittest.TestCase):
 
         self.assertEqual(got, wanted)
 
+        # 按排列序号分区间并行
+        con = cg.cons_specific_cell(
+            [(2, 3, 4), (2, 3, 4), (2, 3, 4), (2, 3, 4)], e_num=(2, 1, 1), workers=2)
+        self.assertEqual(len([i for i in con]), wanted)
+
         # Zinc-blende conventional cell
         fcc_latt = [5, 0, 0,
                     0, 5, 0,
@@ -122,3 +154,230 @@ class TestDerive(unittest.TestCase):
         got = len([i for i in con])
 
         self.assertEqual(got, wanted)
+
+    def test_count_specific_volume(self):
+        # 与 test_cons_specific_volume 中枚举得到的数目一致
+        wanted = [2, 6, 12, 41]
+        cg = CG(self.fcc_pcell)
+        got = [sum(n for _, n in cg.count_specific_volume([(1, 5), (2,)], v))
+               for v in [1, 2, 3, 4]]
+        self.assertEqual(got, wanted)
+
+        counts = cg.count_specific_volume([(1, 5), (2,)], 4, e_num=(3, 1))
+        self.assertEqual(sum(n for _, n in counts), 7)
+
+    def test_count_specific_cell(self):
+        fcc_latt = [5, 0, 0,
+                    0, 5, 0,
+                    0, 0, 5]
+        fcc_pos = [(0, 0, 0),
+                   (0, 0.5, 0.5),
+                   (0.5, 0, 0.5),
+                   (0.5, 0.5, 0)]
+        fcc_atoms = [0, 0, 0, 0]
+        con_cell = Cell(fcc_latt, fcc_pos, fcc_atoms)
+        cg = CG(con_cell)
+        self.assertEqual(cg.count_specific_cell([(2, 3)] * 4), 5)
+        self.assertEqual(
+            cg.count_specific_cell([(2, 3, 4)] * 4, e_num=(2, 1, 1)), 1)
+
+    def test_count_table_specific_volume(self):
+        cg = CG(self.fcc_pcell)
+        table = cg.count_table_specific_volume([(1, 5), (2,)], 4)
+        self.assertEqual(list(table.keys()),
+                         [(0, 4), (1, 3), (2, 2), (3, 1), (4, 0)])
+        self.assertEqual(table[(3, 1)], 7)
+        self.assertEqual(sum(table.values()), 41)
+
+    def test_cons_specific_cell_workers(self):
+        fcc_latt = [5, 0, 0,
+                    0, 5, 0,
+                    0, 0, 10]
+        fcc_pos = [(0, 0, 0),
+                   (0, 0.5, 0.25),
+                   (0.5, 0, 0.25),
+                   (0.5, 0.5, 0),
+                   (0, 0, 0.5),
+                   (0, 0.5, 0.75),
+                   (0.5, 0, 0.75),
+                   (0.5, 0.5, 0.5)]
+        con_cell = Cell(fcc_latt, fcc_pos, [0] * 8)
+        cg = CG(con_cell)
+        sites = [(2, 3)] * 8
+        serial = [(c.atoms.tolist(), d) for c, d in
+                  cg.cons_specific_cell(sites, e_num=(4, 4), method='ccsort')]
+        parallel = [(c.atoms.tolist(), d) for c, d in
+                    cg.cons_specific_cell(sites, e_num=(4, 4), workers=3)]
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(serial), cg.count_specific_cell(sites, e_num=(4, 4)))
+
+    def test_sample_specific_cell(self):
+        fcc_latt = [5, 0, 0,
+                    0, 5, 0,
+                    0, 0, 10]
+        fcc_pos = [(0, 0, 0),
+                   (0, 0.5, 0.25),
+                   (0.5, 0, 0.25),
+                   (0.5, 0.5, 0),
+                   (0, 0, 0.5),
+                   (0, 0.5, 0.75),
+                   (0.5, 0, 0.75),
+                   (0.5, 0.5, 0.5)]
+        con_cell = Cell(fcc_latt, fcc_pos, [0] * 8)
+        cg = CG(con_cell)
+        sites = [(2, 3)] * 8
+        wanted = [(c.atoms.tolist(), d) for c, d in
+                  cg.cons_specific_cell(sites, e_num=(4, 4), method='ccsort')]
+        got = [(c.atoms.tolist(), d) for c, d in
+               cg.sample_specific_cell(sites, 3, e_num=(4, 4), uniform=True, seed=0)]
+        self.assertEqual(len(got), 3)
+        for i in got:
+            self.assertIn(i, wanted)
+        got = [(c.atoms.tolist(), d) for c, d in
+               cg.sample_specific_cell(sites, 1000, e_num=(4, 4), seed=0)]
+        self.assertEqual(sorted(got), sorted(wanted))
+
+    def test_cons_specific_volume_checkpoint(self):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'ckpt.json')
+        try:
+            cg = CG(self.fcc_pcell)
+            sites = [(1, 5), (2,)]
+            wanted = [(c.atoms.tolist(), d) for c, d in
+                      cg.cons_specific_volume(sites, 4)]
+
+            confs = cg.cons_specific_volume(sites, 4, checkpoint=filename)
+            got = [(c.atoms.tolist(), d) for c, d in
+                   [next(confs) for _ in range(20)]]
+            confs.close()
+            # 最后一个构型在生成器关闭时可能还没有处理完，继续时会重新给出
+            self.assertEqual(read_checkpoint(filename)['count'], 19)
+            got = got[:19]
+
+            got += [(c.atoms.tolist(), d) for c, d in
+                    cg.cons_specific_volume(sites, 4, checkpoint=filename)]
+            self.assertEqual(got, wanted)
+            self.assertEqual(read_checkpoint(filename)['count'], 41)
+
+            with self.assertRaises(ValueError):
+                next(cg.cons_specific_volume(sites, 3, checkpoint=filename))
+            with self.assertRaises(ValueError):
+                next(cg.cons_specific_volume(sites, 4, symprec=1e-3, checkpoint=filename))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cons_specific_cell_checkpoint(self):
+        fcc_latt = [5, 0, 0,
+                    0, 5, 0,
+                    0, 0, 10]
+        fcc_pos = [(0, 0, 0),
+                   (0, 0.5, 0.25),
+                   (0.5, 0, 0.25),
+                   (0.5, 0.5, 0),
+                   (0, 0, 0.5),
+                   (0, 0.5, 0.75),
+                   (0.5, 0, 0.75),
+                   (0.5, 0.5, 0.5)]
+        cg = CG(Cell(fcc_latt, fcc_pos, [0] * 8))
+        sites = [(2, 3, 4)] * 8
+        e_num = (4, 2, 2)
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'ckpt.json')
+        ranks = _Progress.ranks
+        try:
+            # 每处理64个排列标记一次进度
+            _Progress.ranks = 64
+            wanted = [(c.atoms.tolist(), d) for c, d in
+                      cg.cons_specific_cell(sites, e_num, method='ccsort')]
+            confs = cg.cons_specific_cell(sites, e_num, method='ccsort', checkpoint=filename)
+            n = len(wanted) // 2
+            got = [(c.atoms.tolist(), d) for c, d in
+                   [next(confs) for _ in range(n + 1)]]
+            confs.close()
+            state = read_checkpoint(filename)
+            self.assertEqual(state['count'], n)
+            self.assertGreater(state['rank'], 0)
+            got = got[:n]
+
+            # 方法或母体结构不同时不能继续
+            with self.assertRaises(ValueError):
+                next(cg.cons_specific_cell(sites, e_num, method='jshash', checkpoint=filename))
+            other = CG(Cell(numpy.array(fcc_latt) * 1.1, fcc_pos, [0] * 8))
+            with self.assertRaises(ValueError):
+                next(other.cons_specific_cell(sites, e_num, method='ccsort', checkpoint=filename))
+
+            got += [(c.atoms.tolist(), d) for c, d in
+                    cg.cons_specific_cell(sites, e_num, method='ccsort', checkpoint=filename)]
+            self.assertEqual(got, wanted)
+        finally:
+            _Progress.ranks = ranks
+            shutil.rmtree(tmpdir)
+
+
+
+class TestPermutationGroup(unittest.TestCase):
+
+    def setUp(self):
+        hcp_latt = [2.5, 0, 0,
+                    -1.25, 2.165, 0,
+                    0, 0, 4]
+        hcp_pos = [(1 / 3, 2 / 3, 0.25), (2 / 3, 1 / 3, 0.75)]
+        self.hcp_pcell = Cell(hcp_latt, hcp_pos, [1, 1])
+
+    def _all_ops_perms(self, mat):
+        # 对超胞的每个对称操作，逐个比较坐标求置换
+        supercell = self.hcp_pcell.extend(mat)
+        syms = supercell.get_symmetry()
+        positions = supercell.positions
+        perms = []
+        for r, t in zip(syms['rotations'], syms['translations']):
+            new_positions = numpy.matmul(positions, r.T) + t
+            perm = []
+            for row in positions:
+                delta = new_positions - row
+                delta = delta - numpy.around(delta)
+                perm.append(numpy.where(numpy.all(numpy.abs(delta) < 1e-5, axis=1))[0][0])
+            perms.append(perm)
+        return numpy.unique(perms, axis=0)
+
+    def test_get_symmetry_perms(self):
+        for volume in [2, 3, 4]:
+            for h in non_dup_hnfs(self.hcp_pcell, volume):
+                pg = PermutationGroup(self.hcp_pcell, h)
+                got = pg.get_symmetry_perms()
+                self.assertTrue(numpy.array_equal(got, self._all_ops_perms(h)))
+                self.assertTrue(numpy.array_equal(got, pg.get_symmetry_perms(method='spglib')))
+                rots = pg.get_rotation_perms()
+                self.assertEqual(len(rots) * volume, len(got))
+
+    def test_get_symmetry_perms_perovskite(self):
+        latt = [4, 0, 0, 0, 4, 0, 0, 0, 4]
+        pos = [(0, 0, 0), (0.5, 0.5, 0.5), (0.5, 0.5, 0), (0.5, 0, 0.5), (0, 0.5, 0.5)]
+        pcell = Cell(latt, pos, [1, 2, 3, 3, 3])
+        mat = numpy.array([[1, 0, 1], [0, 2, 1], [0, 0, 3]])
+        pg = PermutationGroup(pcell, mat)
+        self.assertTrue(numpy.array_equal(pg.get_symmetry_perms(),
+                                          pg.get_symmetry_perms(method='spglib')))
+        with self.assertRaises(ValueError):
+            pg.get_rotation_perms(method='unknown')
+
+    def test_match_positions(self):
+        origin = numpy.array([[1 / 3, 2 / 3, 0.25], [2 / 3, 1 / 3, 0.75]])
+        positions = numpy.array([[2 / 3, 1 / 3, -0.25], [1 / 3 + 1, 2 / 3, 0.25 + 1e-7]])
+        idx, shifts = _match_positions(positions, origin)
+        self.assertEqual(idx.tolist(), [1, 0])
+        self.assertEqual(shifts.tolist(), [[0, 0, -1], [1, 0, 0]])
+        with self.assertRaises(ValueError):
+            _match_positions(numpy.array([[0.5, 0.5, 0.5]]), origin)
+
+    def test_get_pure_translation_perms(self):
+        mat = numpy.array([[1, 1, 0], [0, 2, 0], [0, 0, 2]])
+        pg = PermutationGroup(self.hcp_pcell, mat)
+        trans = pg.get_pure_translation_perms()
+        self.assertEqual(trans.shape, (4, 8))
+        # 平移置换构成群，且不改变位点所属的原胞原子
+        got = set(tuple(t[s]) for t in trans for s in trans)
+        self.assertEqual(got, set(tuple(t) for t in trans))
+        self.assertTrue(numpy.all(trans // 4 == numpy.arange(8) // 4))
+        # 相同snf的超胞共用同一张平移表
+        self.assertIn(((1, 2, 2), 2), _translations_of_snf)
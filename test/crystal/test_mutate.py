@@ -165,3 +165,16 @@ class TestMutableMethods(unittest.TestCase):
                           [(0.350, 0.850, 0.425), "S"],
                           [(0.350, 0.850, 0.925), "Vacc"]]
         self.assertEqual(mcell._sites, expected_sites)
+
+    def test_zero_radius(self):
+        # 半径为零时圆内没有位点，结构不变
+        lattice = numpy.array([5.5, 0, 0,
+                               0, 5.5, 0,
+                               0, 0, 11.0]).reshape((3, 3))
+        sites = [[(0.100, 0.100, 0.050), "Zn"],
+                 [(0.350, 0.350, 0.175), "S"]]
+        mcell = MutableCell(numpy.copy(lattice), sites=copy.deepcopy(sites))
+        remove_sites_in_a_circle(mcell, (0.1, 0.1, 0.05), 0)
+        self.assertEqual(mcell._sites, sites)
+        rotate_sites_in_a_circle_by_z(mcell, (0.1, 0.1, 0.05), radius=0, degrees=90)
+        self.assertEqual(mcell._sites, sites)
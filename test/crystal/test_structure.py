@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import unittest
+import copy
+import pickle
 import numpy
+import spglib
+from itertools import product
 
-from sagar.crystal.structure import Cell, MutableCell
+from sagar.crystal.structure import Cell, MutableCell, neighbor_list
 
 
 class TestUtils(unittest.TestCase):
@@ -97,6 +101,31 @@ class TestCell(unittest.TestCase):
         numpy.testing.assert_almost_equal(ext_fcc.atoms, wanted_atoms)
         # TODO: more complex test case needed
 
+    def test_extend_skewed(self):
+        fcc_latt = [0, 5, 5,
+                    5, 0, 5,
+                    5, 5, 0]
+        fcc_pos = [(0, 0, 0),
+                   (0.25, 0.25, 0.25)]
+        fcc_pcell = Cell(fcc_latt, fcc_pos, [1, 2])
+        op_ext = numpy.array([1, 7, 3,
+                              0, 1, 11,
+                              0, 0, 30]).reshape((3, 3))
+        ext_fcc = fcc_pcell.extend(op_ext)
+        self.assertEqual(ext_fcc.atoms.tolist(), [1] * 30 + [2] * 30)
+        # 每个位点在原胞中的坐标减去原子坐标为格点，且格点互不等价
+        frac = numpy.matmul(ext_fcc.positions, op_ext)
+        points = frac - numpy.repeat(fcc_pcell.positions, 30, axis=0)
+        numpy.testing.assert_almost_equal(points, numpy.around(points))
+        in_cell = numpy.matmul(numpy.around(points[:30]), numpy.linalg.inv(op_ext))
+        in_cell = numpy.around(numpy.mod(in_cell, 1) * 30).astype('int') % 30
+        self.assertEqual(len(set(map(tuple, in_cell.tolist()))), 30)
+
+        with self.assertRaises(ValueError):
+            fcc_pcell.extend(numpy.diag([1, 1.5, 2]))
+        with self.assertRaises(ValueError):
+            fcc_pcell.extend(numpy.zeros((3, 3)))
+
     def test_extend_bug(self):
         sc_latt = [4, 0, 0,
                    0, 4, 0,
@@ -125,6 +154,69 @@ class TestCell(unittest.TestCase):
         bcc_pcell = Cell(bcc_latt, bcc_pos, bcc_atoms)
         self.assertTrue(bcc_pcell.is_primitive())
 
+    def test_symmetry_dataset_cached(self):
+        sc_latt = [4, 0, 0,
+                   0, 4, 0,
+                   0, 0, 4]
+        sc_pcell = Cell(sc_latt, [(0, 0, 0)], [1])
+        ext_sc = sc_pcell.extend(numpy.diag([1, 1, 2]))
+        spg_cell = (ext_sc.lattice, ext_sc.positions, ext_sc.atoms)
+
+        wanted = spglib.get_symmetry(spg_cell, 1e-5)
+        got = ext_sc.get_symmetry()
+        for k in wanted:
+            numpy.testing.assert_almost_equal(got[k], wanted[k])
+        self.assertEqual(ext_sc.get_spacegroup(), spglib.get_spacegroup(spg_cell, 1e-5))
+        self.assertFalse(ext_sc.is_primitive())
+        self.assertTrue(sc_pcell.is_primitive())
+        self.assertEqual(len(ext_sc.get_pure_translations()), 32)
+        # 只调用一次spglib，结果只读
+        self.assertIs(ext_sc.get_rotations(), ext_sc.get_symmetry()['rotations'])
+        self.assertEqual(list(ext_sc._datasets.keys()), [1e-5])
+        with self.assertRaises(ValueError):
+            ext_sc.get_rotations()[0, 0, 0] = 2
+        # 不同精度分别计算
+        ext_sc.get_rotations(symprec=1e-3)
+        self.assertEqual(sorted(ext_sc._datasets.keys()), [1e-5, 1e-3])
+
+    def test_immutable(self):
+        cell = Cell([4, 0, 0, 0, 4, 0, 0, 0, 4], [(0, 0, 0), (0.5, 0.5, 0.5)], [1, 2])
+        with self.assertRaises(ValueError):
+            cell.lattice[0, 0] = 5
+        with self.assertRaises(ValueError):
+            cell.positions[0] = (0.1, 0.1, 0.1)
+        with self.assertRaises(ValueError):
+            cell.atoms[0] = 3
+        with self.assertRaises(AttributeError):
+            cell._atoms = numpy.array([3, 3])
+        with self.assertRaises(AttributeError):
+            cell.magmoms = [0, 0]
+
+    def test_hash_eq(self):
+        cell = Cell([4, 0, 0, 0, 4, 0, 0, 0, 4], [(0, 0, 0), (0.5, 0.5, 0.5)], [1, 2])
+        same = Cell(numpy.eye(3) * 4 + 1e-8, [(1 - 1e-8, 0, 0), (0.5, 0.5, 0.5)], ['H', 'He'])
+        self.assertEqual(cell, same)
+        self.assertEqual(hash(cell), hash(same))
+        self.assertEqual(len({cell, same}), 1)
+
+        swapped = Cell([4, 0, 0, 0, 4, 0, 0, 0, 4], [(0, 0, 0), (0.5, 0.5, 0.5)], [2, 1])
+        moved = Cell([4, 0, 0, 0, 4, 0, 0, 0, 4], [(0, 0, 0), (0.5, 0.5, 0.4)], [1, 2])
+        self.assertNotEqual(cell, swapped)
+        self.assertNotEqual(cell, moved)
+        self.assertEqual(len({cell, swapped, moved}), 3)
+        self.assertFalse(cell == 'cell')
+
+    def test_pickle(self):
+        cell = Cell([4, 0, 0, 0, 4, 0, 0, 0, 4], [(0, 0, 0), (0.5, 0.5, 0.5)], [1, 2])
+        cell.get_symmetry()
+        got = pickle.loads(pickle.dumps(cell))
+        self.assertEqual(got, cell)
+        self.assertEqual(hash(got), hash(cell))
+        self.assertEqual(got.get_spacegroup(), cell.get_spacegroup())
+        self.assertFalse(got.positions.flags.writeable)
+        self.assertFalse(got.get_rotations().flags.writeable)
+        self.assertEqual(copy.deepcopy(cell), cell)
+
     def test_get_primitive(self):
         fcc_latt = [5, 0, 0,
                     0, 5, 0,
@@ -168,6 +260,45 @@ class TestCell(unittest.TestCase):
         self.assertFalse(cell.check(limit=0.05))
 
 
+    def test_neighbor_list(self):
+        lattice = numpy.array([[3.0, 0.2, 0.0],
+                               [0.5, 2.5, 0.1],
+                               [0.3, 0.0, 4.0]])
+        positions = numpy.random.uniform(-1, 2, size=(6, 3))
+        images = numpy.array(list(product(range(-4, 5), repeat=3)))
+        for cutoff in (0.8, 2.6, 5.0):
+            idx_c, idx_p, got_images, distances = neighbor_list(lattice, positions, cutoff)
+            got = set(zip(idx_c, idx_p, map(tuple, got_images)))
+            self.assertEqual(len(got), len(idx_c))
+            # 穷举所有的像
+            wanted = set()
+            for i, c in enumerate(positions):
+                for j, p in enumerate(positions):
+                    dists = numpy.linalg.norm(numpy.matmul(p + images - c, lattice), axis=1)
+                    for k in numpy.nonzero(dists <= cutoff)[0]:
+                        if i != j or numpy.any(images[k]):
+                            wanted.add((i, j, tuple(images[k])))
+            self.assertEqual(got, wanted)
+            vecs = numpy.matmul(positions[idx_p] + got_images - positions[idx_c], lattice)
+            numpy.testing.assert_almost_equal(numpy.linalg.norm(vecs, axis=1), distances)
+
+        with self.assertRaises(ValueError):
+            neighbor_list(lattice, positions, 0)
+
+    def test_get_neighbor_list(self):
+        # 简单立方，最近邻6个，每对只出现一次
+        cell = Cell([2, 0, 0, 0, 2, 0, 0, 0, 2], [(0, 0, 0)], [1])
+        pairs, distances, images = cell.get_neighbor_list(2.1)
+        self.assertEqual(len(pairs), 3)
+        numpy.testing.assert_almost_equal(distances, [2, 2, 2])
+        self.assertEqual(sorted(map(tuple, images.tolist())), [(0, 0, 1), (0, 1, 0), (1, 0, 0)])
+
+        cell = Cell([2, 0, 0, 0, 2, 0, 0, 0, 2], [(0, 0, 0), (0.5, 0.5, 0.5)], [1, 2])
+        pairs, distances, images = cell.get_neighbor_list(1.8)
+        self.assertEqual(pairs.tolist(), [[0, 1]] * 8)
+        numpy.testing.assert_almost_equal(distances, [numpy.sqrt(3)] * 8)
+
+
 class TestMutableCell(unittest.TestCase):
 
     def setUp(self):
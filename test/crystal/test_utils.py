@@ -2,10 +2,14 @@
 import unittest
 import numpy
 import copy
+from itertools import product
 
 from sagar.crystal.structure import Cell
 from sagar.crystal.utils import non_dup_hnfs, _is_hnf_dup, _hnfs
-from sagar.crystal.utils import IntMat3x3, snf
+from sagar.crystal.utils import canonical_hnf, _hnf_reduce, _hnf_reduce_batch
+from sagar.crystal.utils import _hnfs_array, _hnfs_2D_array, _is_hnf_dup_batch
+from sagar.crystal.utils import hnf_shapes, count_hnfs, count_non_dup_hnfs
+from sagar.crystal.utils import IntMat3x3, snf, snf_batch
 from sagar.toolkit.mathtool import extended_gcd
 
 
@@ -63,6 +67,121 @@ class TestHnf(unittest.TestCase):
                for i in range(1, 9)]
         self.assertEqual(got, wanted)
 
+    def test_count_hnfs(self):
+        # Results from <PHYSICAL REVIEW B 77, 224115 (2008)> Table III
+        wanted = [1, 7, 13, 35, 31, 91, 57, 155]
+        self.assertEqual([count_hnfs(i) for i in range(1, 9)], wanted)
+        for i in range(1, 13):
+            self.assertEqual(count_hnfs(i), len(_hnfs_array(i)))
+            self.assertEqual(count_hnfs(i, dimension=2), len(_hnfs_2D_array(i)))
+
+    def test_count_non_dup_hnfs(self):
+        # BCC and FCC
+        wanted = [1, 2, 3, 7, 5, 10, 7]
+        got = [count_non_dup_hnfs(self.fcc_pcell, i) for i in range(1, 8)]
+        self.assertEqual(got, wanted)
+        got = [count_non_dup_hnfs(self.bcc_pcell, i) for i in range(1, 8)]
+        self.assertEqual(got, wanted)
+        # HCP
+        wanted = [1, 3, 5, 11, 7, 19, 11, 34]
+        got = [count_non_dup_hnfs(self.hcp_pcell, i) for i in range(1, 9)]
+        self.assertEqual(got, wanted)
+        for i in range(9, 13):
+            self.assertEqual(count_non_dup_hnfs(self.hcp_pcell, i),
+                             len(non_dup_hnfs(self.hcp_pcell, i)))
+
+        # 2D
+        graphene = Cell([2.46, 0, 0, -1.23, 2.130422, 0, 0, 0, 16],
+                        [(0, 0, 0.5), (1. / 3, 2. / 3, 0.5)], [6, 6])
+        for i in range(1, 9):
+            self.assertEqual(count_non_dup_hnfs(graphene, i, dimension=2),
+                             len(non_dup_hnfs(graphene, i, dimension=2)))
+
+    def test_hnf_reduce(self):
+        # 每个hnf化简后不变
+        for h in _hnfs(6):
+            self.assertEqual(_hnf_reduce(h).tolist(), h.tolist())
+        # 行变换不改变格子
+        mat = numpy.array([[0, 2, 1], [1, 0, -1], [-1, 1, 3]])
+        got = _hnf_reduce(mat)
+        self.assertEqual(got[1, 0], 0)
+        self.assertEqual(got[2, :2].tolist(), [0, 0])
+        self.assertEqual(abs(round(numpy.linalg.det(got))), abs(round(numpy.linalg.det(mat))))
+        m = numpy.matmul(mat, numpy.linalg.inv(got))
+        self.assertTrue(numpy.allclose(m, numpy.around(m)))
+
+    def test_canonical_hnf(self):
+        rot_list = self.bcc_pcell.get_rotations_without_inversion()
+        for volume in [2, 4, 6]:
+            hnfs = list(_hnfs(volume))
+            for hnf_x in hnfs[::3]:
+                for hnf_y in hnfs[::2]:
+                    is_dup = _is_hnf_dup(hnf_x, hnf_y, rot_list)
+                    is_same = numpy.array_equal(canonical_hnf(hnf_x, rot_list),
+                                                canonical_hnf(hnf_y, rot_list))
+                    self.assertEqual(is_dup, is_same)
+
+    def test_hnfs_array(self):
+        for volume in [1, 4, 6, 12]:
+            got = _hnfs_array(volume)
+            self.assertEqual(got.shape, (len(list(_hnfs(volume))), 3, 3))
+            self.assertTrue(numpy.all(numpy.around(numpy.linalg.det(got)) == volume))
+            self.assertEqual(len(set(h.tobytes() for h in got)), len(got))
+        got = _hnfs_2D_array(6)
+        self.assertEqual(got.shape, (12, 3, 3))
+        self.assertTrue(numpy.all(got[:, 2] == [0, 0, 1]))
+
+    def test_hnf_reduce_batch(self):
+        mats = numpy.random.randint(-4, 5, size=(200, 3, 3))
+        mats = mats[numpy.abs(numpy.linalg.det(mats)) > 0.5]
+        got = _hnf_reduce_batch(mats)
+        self.assertEqual(got.tolist(), [_hnf_reduce(m).tolist() for m in mats])
+
+    def test_is_hnf_dup_batch(self):
+        rot_list = self.hcp_pcell.get_rotations_without_inversion()
+        hnfs = _hnfs_array(4)
+        for hnf_y in hnfs[::5]:
+            wanted = [_is_hnf_dup(h, hnf_y, rot_list) for h in hnfs]
+            got = _is_hnf_dup_batch(hnfs, hnf_y, rot_list)
+            self.assertEqual(got.tolist(), wanted)
+
+    def test_hnf_shapes(self):
+        hnfs = _hnfs_array(6)
+        distances, aspects = hnf_shapes(self.hcp_pcell, hnfs)
+        # 穷举格点求最短格矢
+        coeffs = numpy.array([c for c in product(range(-6, 7), repeat=3) if any(c)])
+        for h, d in zip(hnfs, distances):
+            vecs = numpy.matmul(coeffs, numpy.matmul(h, self.hcp_pcell.lattice))
+            self.assertAlmostEqual(d, numpy.linalg.norm(vecs, axis=1).min())
+        # 等价的hnf形状相同
+        rot_list = self.hcp_pcell.get_rotations_without_inversion()
+        for hnf_y in hnfs[::7]:
+            same = _is_hnf_dup_batch(hnfs, hnf_y, rot_list)
+            self.assertTrue(numpy.allclose(distances[same], distances[same][0]))
+            self.assertTrue(numpy.allclose(aspects[same], aspects[same][0]))
+        # 立方
+        d, a = hnf_shapes(self.fcc_pcell, [[[1, 1, 1], [0, 2, 0], [0, 0, 2]]])
+        self.assertAlmostEqual(d[0], 10)
+        self.assertAlmostEqual(a[0], 1)
+
+    def test_non_dup_hnfs_shape(self):
+        all_hnfs = non_dup_hnfs(self.fcc_pcell, 8)
+        distances, aspects = hnf_shapes(self.fcc_pcell, all_hnfs)
+
+        got = non_dup_hnfs(self.fcc_pcell, 8, min_distance=10)
+        wanted = [h for h, d in zip(all_hnfs, distances) if d > 10 - 1e-5]
+        self.assertEqual(numpy.array(got).tolist(), numpy.array(wanted).tolist())
+
+        got = non_dup_hnfs(self.fcc_pcell, 8, max_aspect=1.5)
+        wanted = [h for h, a in zip(all_hnfs, aspects) if a < 1.5 + 1e-5]
+        self.assertEqual(numpy.array(got).tolist(), numpy.array(wanted).tolist())
+
+        # fcc扩大4倍最接近立方的是惯用胞
+        got = non_dup_hnfs(self.fcc_pcell, 4, most_cubic=1)
+        self.assertEqual(len(got), 1)
+        self.assertAlmostEqual(hnf_shapes(self.fcc_pcell, got)[1][0], 1)
+        self.assertEqual(len(non_dup_hnfs(self.fcc_pcell, 4, most_cubic=100)), 7)
+
     def test_is_hnf_dup(self):
         hnf_x = numpy.array([[1, 0, 0],
                              [0, 1, 0],
@@ -492,8 +611,8 @@ class TestSnfHnf(unittest.TestCase):
         wanted_a = [1, 7, 13, 35, 31, 91, 57, 155,
                     130, 217, 133, 455, 183, 399, 403, 651]
         # 此为hnf去除旋转对称性后在做snf的结果！
+        # snf满足d1 | d2 | d3，是唯一的，所以与去除旋转对称性之前的结果相同
         wanted_b = [1, 1, 1, 2, 1, 1, 1, 3, 2, 1, 1, 2, 1, 1, 1, 4]
-        wanted_b_quick = [1, 1, 1, 2, 1, 2, 1, 3, 2, 2, 1, 4, 1, 2, 2, 4]
 
         # duplicated hnfs produce test
         a = []
@@ -502,24 +621,48 @@ class TestSnfHnf(unittest.TestCase):
             a.append(len_volume)
         self.assertEqual(a, wanted_a)
 
-        # non-duplicated snfs: b slow test 100+s
-        # b = []
-        # for i in range(1, 17):
-        #     s_set = set()
-        #     for h in non_dup_hnfs(self.fcc_pcell, volume=i):
-        #         snf_D, _, _ = snf(h)
-        #         s_flat_tuple = tuple(numpy.diagonal(snf_D).tolist())
-        #         s_set.add(s_flat_tuple)
-        #     b.append(len(s_set))
-        # self.assertEqual(b, wanted_b)
-
-        # duplicated snfs: b quick test
+        # non-duplicated snfs
         b = []
         for i in range(1, 17):
             s_set = set()
-            for h in _hnfs(i):
+            for h in non_dup_hnfs(self.fcc_pcell, volume=i):
                 snf_D, _, _ = snf(h)
                 s_flat_tuple = tuple(numpy.diagonal(snf_D).tolist())
                 s_set.add(s_flat_tuple)
             b.append(len(s_set))
-        self.assertEqual(b, wanted_b_quick)
+        self.assertEqual(b, wanted_b)
+
+        # duplicated snfs: b quick test
+        b = []
+        for i in range(1, 17):
+            diags, _, _ = snf_batch(_hnfs_array(i))
+            b.append(len(set(tuple(d) for d in diags.tolist())))
+        self.assertEqual(b, wanted_b)
+
+    def test_snf_batch(self):
+        mats = numpy.random.randint(-6, 7, size=(300, 3, 3))
+        mats = mats[numpy.abs(numpy.linalg.det(mats)) > 0.5]
+        mats = numpy.concatenate([mats, _hnfs_array(12)])
+        diags, opL, opR = snf_batch(mats)
+        for mat, d, L, R in zip(mats, diags, opL, opR):
+            self.assertEqual(numpy.matmul(L, numpy.matmul(mat, R)).tolist(),
+                             numpy.diag(d).tolist())
+            self.assertEqual(abs(round(numpy.linalg.det(L))), 1)
+            self.assertEqual(abs(round(numpy.linalg.det(R))), 1)
+            self.assertTrue(d[0] > 0 and d[1] % d[0] == 0 and d[2] % d[1] == 0)
+            # 与IntMat3x3比较：对角元之积相同，满足整除关系时对角元相同
+            wanted = numpy.diagonal(IntMat3x3(mat).get_snf()[0])
+            self.assertEqual(numpy.prod(wanted), numpy.prod(d))
+            if wanted[1] % wanted[0] == 0 and wanted[2] % wanted[1] == 0:
+                self.assertEqual(wanted.tolist(), d.tolist())
+
+    def test_snf_divisibility(self):
+        # Z_2 x Z_3 = Z_6
+        D, L, R = snf(numpy.diag([1, 2, 3]))
+        self.assertEqual(numpy.diagonal(D).tolist(), [1, 1, 6])
+        self.assertEqual(round(numpy.linalg.det(L)), 1)
+        self.assertEqual(round(numpy.linalg.det(R)), 1)
+        mat = numpy.array([[2, 5, -4], [4, -6, -3], [0, -5, -5]])
+        D, L, R = snf(mat)
+        self.assertEqual(numpy.diagonal(D).tolist(), [1, 1, 210])
+        self.assertEqual(numpy.matmul(L, numpy.matmul(mat, R)).tolist(), D.tolist())
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import unittest
+import numpy
+
+from itertools import product
+
+from sagar.toolkit.derivetool import remove_redundant, count_configurations
+from sagar.toolkit.derivetool import count_configurations_all_concentrations
+from sagar.toolkit.derivetool import remove_redundant_by_order, split_ranks
+from sagar.toolkit.derivetool import num_arrangements, rank_arrangement, unrank_arrangement
+from sagar.toolkit.derivetool import canonical_block, transmuted_keys, canonical_labels
+from sagar.toolkit.derivetool import sample_configurations, orbit_sizes
+from sagar.toolkit.derivetool import _pack_atoms, _hashable_keys, _atoms_blocks
+
+
+class TestDeriveTool(unittest.TestCase):
+
+    def setUp(self):
+        # 正方形四个顶点的所有对称操作 (D4)
+        self.square_perms = numpy.array([[0, 1, 2, 3],
+                                         [1, 2, 3, 0],
+                                         [2, 3, 0, 1],
+                                         [3, 0, 1, 2],
+                                         [3, 2, 1, 0],
+                                         [0, 3, 2, 1],
+                                         [1, 0, 3, 2],
+                                         [2, 1, 0, 3]])
+        self.square_positions = numpy.array([[0, 0, 0],
+                                             [1, 0, 0],
+                                             [1, 1, 0],
+                                             [0, 1, 0]])
+
+    def test_pack_atoms(self):
+        arr = numpy.array([[0, 1, 2], [2, 1, 0]])
+        got = _pack_atoms(arr, 3)
+        self.assertEqual(got.tolist(), [[5], [21]])
+        self.assertEqual(_hashable_keys(got), [5, 21])
+
+    def test_pack_atoms_multi_words(self):
+        # 3^50 超过64位整数，需要分段
+        arr = numpy.random.randint(3, size=(20, 50))
+        words = _pack_atoms(arr, 3)
+        self.assertGreater(words.shape[-1], 1)
+        keys = _hashable_keys(words)
+        wanted = len(set(''.join(str(i) for i in row) for row in arr))
+        self.assertEqual(len(set(keys)), wanted)
+        # 打包后的键与排列的字典序一致
+        order = sorted(range(20), key=lambda i: keys[i])
+        self.assertEqual([arr[i].tolist() for i in order],
+                         sorted(arr.tolist()))
+
+    def test_remove_redundant_key(self):
+        sites = [(0, 1, 2)] * 4
+        got_int = [(a[1], d) for a, d in remove_redundant(
+            self.square_positions, sites, self.square_perms, key='int')]
+        got_str = [(a[1], d) for a, d in remove_redundant(
+            self.square_positions, sites, self.square_perms, key='str')]
+        self.assertEqual(got_int, got_str)
+        # 三色项链（可翻转）的数目为21
+        self.assertEqual(len(got_int), 21)
+        self.assertEqual(sum(d for _, d in got_int), 3**4)
+
+    def test_canonical_block(self):
+        perms = self.square_perms
+        arr = numpy.array([[1, 0, 0, 0],
+                           [0, 0, 1, 0],
+                           [1, 0, 1, 0],
+                           [1, 1, 1, 1]])
+        canon, degs = canonical_block(arr, perms, 2)
+        self.assertEqual(canon[:, 0].tolist(), [1, 1, 5, 15])
+        self.assertEqual(degs.tolist(), [4, 4, 2, 1])
+
+    def test_canonical_block_multi_words(self):
+        # 50个位点的环上的平移操作，3^50 需要分段打包
+        n = 50
+        perms = numpy.array([numpy.roll(numpy.arange(n), i) for i in range(n)])
+        arr = numpy.random.randint(3, size=(4, n))
+        arr[1] = numpy.roll(arr[0], 7)
+        arr[3] = 0
+        canon, degs = canonical_block(arr, perms, 3)
+        keys = _hashable_keys(canon)
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(degs[3], 1)
+        wanted = min(arr[0][p].tolist() for p in perms)
+        self.assertEqual(_hashable_keys(_pack_atoms(wanted, 3)), keys[0])
+
+    def test_orbit_sizes(self):
+        arr = numpy.array([[0, 0, 0, 0], [0, 1, 0, 1], [0, 0, 1, 1], [0, 0, 1, 2]])
+        got = orbit_sizes(arr, self.square_perms, 3)
+        self.assertEqual(got.tolist(), [1, 2, 4, 8])
+        _, degs = canonical_block(arr, self.square_perms, 3)
+        self.assertEqual(got.tolist(), degs.tolist())
+
+    def test_transmuted_keys(self):
+        arr = numpy.array([[1, 0, 0, 0], [1, 1, 0, 0]])
+        words = transmuted_keys(arr, self.square_perms, 2)
+        self.assertEqual(words.shape, (2, 8, 1))
+        wanted = [int(''.join(str(i) for i in arr[1][p]), 2)
+                  for p in self.square_perms]
+        self.assertEqual(words[1, :, 0].tolist(), wanted)
+
+    def test_remove_redundant_by_order(self):
+        sites = [(0, 1, 2)] * 4
+        got_hash = sorted((a[1], d) for a, d in remove_redundant(
+            self.square_positions, sites, self.square_perms, method='jshash'))
+        got_order = sorted((a[1], d) for a, d in remove_redundant(
+            self.square_positions, sites, self.square_perms, method='ccsort'))
+        self.assertEqual(got_order, got_hash)
+
+        got = [d for _, d in remove_redundant(
+            self.square_positions, sites, self.square_perms, e_num=(2, 1, 1),
+            method='ccsort')]
+        # 两个不同原子相邻（8种）或相对（4种）
+        self.assertEqual(sorted(got), [4, 8])
+
+    def test_canonical_labels(self):
+        arr = numpy.array([[1, 0, 0, 2], [2, 1, 0, 0]])
+        labels, canon, degs = canonical_labels(arr, self.square_perms, 3)
+        self.assertEqual(labels.tolist(), [[0, 0, 1, 2], [0, 0, 1, 2]])
+        wanted, wanted_degs = canonical_block(arr, self.square_perms, 3)
+        self.assertEqual(canon.tolist(), wanted.tolist())
+        self.assertEqual(degs.tolist(), wanted_degs.tolist())
+
+    def test_sample_configurations(self):
+        sites = [(0, 1, 2)] * 4
+        wanted = [(a[1], d) for a, d in remove_redundant_by_order(
+            self.square_positions, sites, self.square_perms, None)]
+        for uniform in (False, True):
+            got = [(a[1], d) for a, d in sample_configurations(
+                self.square_positions, sites, self.square_perms, 8,
+                uniform=uniform, seed=0)]
+            self.assertEqual(len(got), 8)
+            for i in got:
+                self.assertIn(i, wanted)
+            again = [(a[1], d) for a, d in sample_configurations(
+                self.square_positions, sites, self.square_perms, 8,
+                uniform=uniform, seed=0)]
+            self.assertEqual(again, got)
+            # 样本数多于不等价构型数时，给出全部构型
+            got = [(a[1], d) for a, d in sample_configurations(
+                self.square_positions, sites, self.square_perms, 100,
+                e_num=(2, 1, 1), uniform=uniform, seed=1)]
+            self.assertEqual(sorted(got), [([0, 0, 1, 2], 8), ([0, 1, 0, 2], 4)])
+
+    def test_sample_configurations_uniform(self):
+        # 两色项链 0011 (简并度4) 与 0101 (简并度2)，均匀抽样时出现次数相近
+        sites = [(0, 1)] * 4
+        counts = {}
+        for seed in range(400):
+            for a, d in sample_configurations(self.square_positions, sites, self.square_perms,
+                                              1, e_num=(2, 2), uniform=True, seed=seed):
+                counts[d] = counts.get(d, 0) + 1
+        self.assertEqual(sorted(counts), [2, 4])
+        self.assertGreater(counts[2], 140)
+        self.assertGreater(counts[4], 140)
+
+    def test_count_configurations(self):
+        sites = [(0, 1, 2)] * 4
+        self.assertEqual(count_configurations(sites, self.square_perms), 21)
+        self.assertEqual(count_configurations(
+            sites, self.square_perms, e_num=(2, 1, 1)), 2)
+        # 不同的位点可取元素数不同
+        sites = [(0, 1), (0, 1, 2), (0, 1), (0, 1, 2)]
+        perms = self.square_perms[[0, 2, 5, 7]]
+        wanted = len(list(remove_redundant(
+            self.square_positions, sites, perms)))
+        self.assertEqual(count_configurations(sites, perms), wanted)
+
+    def test_count_configurations_all_concentrations(self):
+        sites = [(0, 1, 2)] * 4
+        table = count_configurations_all_concentrations(sites, self.square_perms)
+        self.assertEqual(sum(table.values()), 21)
+        for e_num, n in table.items():
+            self.assertEqual(
+                n, count_configurations(sites, self.square_perms, e_num))
+
+    def test_remove_redundant_by_order_translations(self):
+        # 正方形的平移（转动）子群与两个陪集代表元
+        trans = self.square_perms[:4]
+        rots = self.square_perms[[0, 4]]
+        sites = [(0, 1, 2)] * 4
+        wanted = list(remove_redundant_by_order(
+            self.square_positions, sites, self.square_perms, None))
+        got = list(remove_redundant_by_order(
+            self.square_positions, sites, rots, None, translations=trans))
+        self.assertEqual([(a[1], d) for a, d in got], [(a[1], d) for a, d in wanted])
+
+    def test_remove_redundant_by_order_ranges(self):
+        sites = [(0, 1, 2)] * 4
+        e_num = (2, 1, 1)
+        whole = [(a[1], d) for a, d in remove_redundant_by_order(
+            self.square_positions, sites, self.square_perms, e_num)]
+        ranges = split_ranks(e_num, 5)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 12)
+        merged = []
+        for start, stop in ranges:
+            merged += [(a[1], d) for a, d in remove_redundant_by_order(
+                self.square_positions, sites, self.square_perms, e_num, start, stop)]
+        self.assertEqual(merged, whole)
+
+    def test_rank_unrank_arrangement(self):
+        e_num = (3, 2, 2)
+        total = num_arrangements(e_num)
+        self.assertEqual(total, 210)
+        arrangements = set()
+        for i in range(total):
+            arr = unrank_arrangement(i, e_num)
+            self.assertEqual(rank_arrangement(arr, e_num), i)
+            arrangements.add(tuple(arr))
+        self.assertEqual(len(arrangements), total)
+
+        # 大的浓度空间
+        e_num = (20, 20, 24)
+        total = num_arrangements(e_num)
+        for i in [0, total // 3, total - 1]:
+            arr = unrank_arrangement(i, e_num)
+            self.assertEqual(rank_arrangement(arr, e_num), i)
+        with self.assertRaises(ValueError):
+            unrank_arrangement(total, e_num)
+
+    def test_atoms_blocks(self):
+        args = [2, 1, 3, 2]
+        got = numpy.concatenate(list(_atoms_blocks(args, block_size=5)))
+        self.assertEqual(got.dtype, numpy.uint8)
+        wanted = list(product(*[range(i) for i in args]))
+        self.assertEqual([tuple(r) for r in got.tolist()], wanted)
+
+        e_num = (2, 1, 2)
+        blocks = list(_atoms_blocks(args + [3, 3], e_num, block_size=7, start=3, stop=29))
+        self.assertTrue(all(len(b) <= 7 for b in blocks))
+        got = numpy.concatenate(blocks)
+        self.assertEqual(got.shape, (26, 6))
+        self.assertTrue(numpy.all(got[:, 1] == 0))
+        for i, row in enumerate(got):
+            self.assertEqual(
+                rank_arrangement(row[[0, 2, 3, 4, 5]], e_num), 3 + i)
+
+    def test_dilute_many_sites(self):
+        # 72个位点中只有2个被替换：排列总数很小，但C(72, 36)超过int64
+        n = 72
+        positions = numpy.zeros((n, 3))
+        perms = numpy.array([numpy.roll(numpy.arange(n), i) for i in range(n)])
+        sites = [(0, 1)] * n
+        for method in ('jshash', 'ccsort'):
+            got = sorted(d for _, d in remove_redundant(
+                positions, sites, perms, e_num=(70, 2), method=method))
+            # 环上两点的距离为1~36，距离为36时等价的排列只有36个
+            self.assertEqual(got, [36] + [72] * 35)
+        block = next(_atoms_blocks([2] * n, (70, 2), 4, start=num_arrangements((70, 2)) - 4))
+        self.assertEqual([rank_arrangement(row, (70, 2)) for row in block],
+                         [2552, 2553, 2554, 2555])
+
+    def test_atoms_blocks_large_ranks(self):
+        # C(68, 34) 超过int64
+        e_num = (34, 34)
+        total = num_arrangements(e_num)
+        self.assertGreater(total, 2 ** 63)
+        block = next(_atoms_blocks([2] * 68, e_num, 4, start=total - 4))
+        for i, row in enumerate(block):
+            self.assertEqual(rank_arrangement(row, e_num), total - 4 + i)
+
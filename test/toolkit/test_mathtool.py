@@ -3,6 +3,7 @@ import unittest
 import numpy
 
 from sagar.toolkit.mathtool import distance, closest_pair, extended_gcd
+from sagar.toolkit.mathtool import binomialCoeff
 
 
 class TestCommonUtils(unittest.TestCase):
@@ -23,7 +24,10 @@ class TestCommonUtils(unittest.TestCase):
         pass
 
     def test_binomial_coeff(self):
-        pass
+        self.assertEqual(binomialCoeff(4, 2), 6)
+        self.assertEqual(binomialCoeff(5, 0), 1)
+        # 浮点数除法在此处会有误差
+        self.assertEqual(binomialCoeff(68, 34), 28453041475240576740)
 
     def test_refine_positions(self):
         pass